@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''
+Benchmark the image processing with synthetic all-sky images.
+
+For every camera synthetic frames get rendered from the star catalogue (projected with
+skycam.horizontal2image) with drifting clouds, noise and the moon. The frames are used to time
+process_image, update_star_position, calc_cloud_map, ratescan and the batch mode of the
+starry_night script at several image and process counts. Results are appended to a CSV file,
+so runs of different versions can be compared.
+
+Usage:
+    benchmark.py [options]
+
+Options:
+    --cameras=<c>   Comma separated list of bundled camera configs [default: GTC,Magic,CTA]
+    --images=<n>    Comma separated list of image counts [default: 8,32]
+    --processes=<n> Comma separated list of process counts [default: 1,2,4]
+    --clouds=<f>    Fraction of the sky covered by clouds [default: 0.3]
+    --noise=<s>     Standard deviation of the noise of the sky background [default: 0.005]
+    --start=<time>  Time of the first frame (UTC). There is a bright moon on e.g.
+                    '2016-03-23 23:00' [default: 2016-03-10 22:00]
+    --cadence=<m>   Minutes between two frames [default: 2]
+    --seed=<n>      Seed of the random numbers [default: 0]
+    --repeat=<n>    Repeat every single stage measurement, the best one is kept [default: 3]
+    --skip=<b>      Comma separated list of benchmarks to skip, e.g. 'cli,ratescan'
+    --script=<file> starry_night script used for the batch benchmark. Default: the one of this repository
+    --output=<file> Append results to this CSV file [default: benchmark.csv]
+    --keep=<dir>    Write the synthetic frames to <dir> instead of a temporary directory
+'''
+
+from docopt import docopt
+import logging
+import os
+import sys
+import time
+import subprocess
+import tempfile
+import tracemalloc
+import configparser
+import pkg_resources
+import ephem
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from scipy.io import savemat
+from scipy.ndimage import gaussian_filter
+
+from starry_night import skycam
+from starry_night.profiling import StageProfiler
+
+repository = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# read only context of a worker process, see init_worker
+context = dict()
+
+
+def read_config(name):
+    '''
+    Returns the parsed bundled config file of camera 'name'
+    '''
+    config = configparser.RawConfigParser()
+    try:
+        config.read(pkg_resources.resource_filename('starry_night', 'data/{}_cam.config'.format(name)))
+    except configparser.MissingSectionHeaderError:
+        # e.g. the IceCube config is not in the format skycam expects
+        raise ValueError('Config of camera {} has no sections and can not be used'.format(name))
+    if not config.has_section('image'):
+        raise ValueError('There is no bundled config of camera {}'.format(name))
+    return config
+
+
+def process_args(name, **options):
+    '''
+    Returns the options of the starry_night script that process_image reads,
+    all disabled except the ones given in options
+    '''
+    args = {key: False for key in ['--blobsize', '--cam', '--cloudmap', '--cloudtrack', '--daemon', '--float32',
+        '--kernel', '--low-memory', '--profile', '--ratescan', '--response', '--single', '--sql',
+        '--store', '-p', '-s', '-v']}
+    args['--function'] = 'LoG'
+    args['-c'] = name
+    args.update(options)
+    return args
+
+
+def cloud_field(shape, fraction, scale, rng):
+    '''
+    Returns a smooth periodic cloud field of shape with values between 0 (clear) and 1 (cloud),
+    'fraction' of all pixels are covered. 'scale' is the typical size of a cloud in pixels.
+    '''
+    field = gaussian_filter(rng.normal(size=shape), scale, mode='wrap')
+    if fraction <= 0:
+        return np.zeros(shape)
+    threshold = np.percentile(field, 100 * (1 - fraction))
+    return np.clip((field - threshold) / (0.5 * field.std()) + 0.5, 0, 1)
+
+
+def render_frame(stars, flux, config, timestamp, clouds, noise, rng, psf=1.):
+    '''
+    Render a synthetic image of the sky at timestamp. Stars get projected with
+    skycam.horizontal2image and their flux (array, one value per star) gets dimmed by
+    clouds (see cloud_field), which also scatter a little light.
+    The moon is a saturated disc with a halo, if it is above the horizon.
+    '''
+    res = [int(r) for r in config['image']['resolution'].split(',')]
+    observer = skycam.obs_setup(config['properties'])
+    observer.date = timestamp
+
+    az, alt = skycam.equatorial2horizontal(stars.ra.values, stars.dec.values, observer)
+    x, y = skycam.horizontal2image(az, alt, config['image'])
+    keep = (alt > 0) & (0 <= x) & (x < res[0] - 1) & (0 <= y) & (y < res[1] - 1)
+    x, y = x[keep], y[keep]
+    flux = flux[keep] * (1 - 0.95 * clouds[y.astype(int), x.astype(int)])
+
+    # distribute the flux of every star to its 4 neighbouring pixels and blur with the psf
+    img = np.zeros((res[1], res[0]))
+    col, row = x.astype(int), y.astype(int)
+    dx, dy = x - col, y - row
+    for r, c, w in ((row, col, (1-dx)*(1-dy)), (row, col+1, dx*(1-dy)), (row+1, col, (1-dx)*dy), (row+1, col+1, dx*dy)):
+        np.add.at(img, (r, c), flux*w)
+    img = gaussian_filter(img, psf)
+    img += 0.1 + 0.02 * clouds
+    if noise > 0:
+        img += rng.normal(0, noise, img.shape)
+
+    moon = ephem.Moon()
+    moon.compute(observer)
+    if moon.alt > 0:
+        moonX, moonY = skycam.horizontal2image(float(moon.az), float(moon.alt), config['image'])
+        radius = float(config['image']['radius'])
+        distance = np.hypot(*np.ogrid[-moonY:res[1]-moonY, -moonX:res[0]-moonX])
+        img += 0.5 * moon.moon_phase * np.exp(-distance / (0.1 * radius))
+        img[distance < 0.01 * radius] = 1
+    return img
+
+
+def star_flux(stars, config, timestamp):
+    '''
+    Returns the flux of every star, so that the filter response of stars in a clear sky is
+    twice the upper visibility limit of the camera. The response of a star with unit flux
+    is measured in a noise free rendering at timestamp.
+    '''
+    res = [int(r) for r in config['image']['resolution'].split(',')]
+    img = render_frame(stars, np.ones(len(stars.index)), config, timestamp, np.zeros((res[1], res[0])), 0, None)
+    response = skycam.filterBank(img, [float(config['analysis']['kernelsize'])], 'LoG')
+
+    observer = skycam.obs_setup(config['properties'])
+    observer.date = timestamp
+    az, alt = skycam.equatorial2horizontal(stars.ra.values, stars.dec.values, observer)
+    x, y = skycam.horizontal2image(az, alt, config['image'])
+    keep = (alt > 0.3) & (10 < x) & (x < res[0] - 10) & (10 < y) & (y < res[1] - 10)
+    gain = np.nanmedian(skycam.findLocalMax(response, x[keep], y[keep], 1)[2][-1])
+
+    upper = [float(l) for l in config['analysis']['visibleupperlimit'].split(',')]
+    return 2 * 10**(stars.vmag.values * upper[0] + upper[1]) / gain
+
+
+def synthetic_frames(config, count, start, cadence, fraction, noise, seed):
+    '''
+    Yield 'count' image dictionaries (see skycam.getImageDict) of synthetic frames every
+    'cadence' minutes. Clouds drift from west to east with 5 pixels per frame.
+    '''
+    rng = np.random.default_rng(seed)
+    stars = skycam.celObjects_dict(config)['stars']
+    flux = star_flux(stars, config, start)
+    res = [int(r) for r in config['image']['resolution'].split(',')]
+    clouds = cloud_field((res[1], res[0]), fraction, res[0] / 40, rng)
+    for i in range(count):
+        timestamp = start + timedelta(minutes=cadence*i)
+        img = render_frame(stars, flux, config, timestamp, np.roll(clouds, 5*i, axis=1), noise, rng)
+        yield {'img': img, 'timestamp': timestamp}
+
+
+def write_frames(frames, directory, config):
+    '''
+    Write frames as matlab files, which the starry_night script can read. Returns all filenames.
+    '''
+    filenames = []
+    for i, frame in enumerate(frames):
+        # getImageDict adds the time offset of the camera
+        utc = frame['timestamp'] - timedelta(minutes=float(config['properties']['timeoffset']))
+        filename = os.path.join(directory, '{}_{:04d}.mat'.format(config['properties']['name'], i))
+        savemat(filename, {'pic1': frame['img'], 'UTC1': [utc.strftime('%Y/%m/%d %H:%M:%S')]})
+        filenames.append(filename)
+    return filenames
+
+
+def measure(func, repeat=1):
+    '''
+    Returns best wall time and its CPU time of 'repeat' calls of func and the peak memory
+    of one more call, which is traced with tracemalloc (tracing slows down the call)
+    '''
+    profiler = StageProfiler(memory=False)
+    for i in range(repeat):
+        profiler.start('run')
+        func()
+    profiler.stop()
+    best = min(profiler.records, key=lambda r: r['wall'])
+
+    tracing = tracemalloc.is_tracing()
+    profiler = StageProfiler()
+    profiler.start('memory')
+    func()
+    profiler.stop()
+    if not tracing:
+        tracemalloc.stop()
+    return {'seconds': best['wall'], 'cpu': best['cpu'], 'peak_memory': profiler.records[0]['peak_memory']}
+
+
+def init_worker(config, args):
+    context['config'] = config
+    context['args'] = args
+    context['data'] = skycam.celObjects_dict(config)
+
+
+def process_frame(frame):
+    return skycam.process_image(frame, context['data'], context['config'], context['args'])
+
+
+def ready(i):
+    return i
+
+
+def bench_process_image(frames, config, args, processes):
+    '''
+    Time process_image of all frames in 'processes' worker processes (in this process if 1).
+    The setup of the workers is not included.
+    '''
+    if processes == 1:
+        init_worker(config, args)
+        process_frame({'img': frames[0]['img'].copy(), 'timestamp': frames[0]['timestamp']})
+        # process_image writes to the image, so every call gets a fresh copy
+        def run():
+            for frame in frames:
+                process_frame({'img': frame['img'].copy(), 'timestamp': frame['timestamp']})
+        return measure(run)
+
+    pool = Pool(processes=processes, initializer=init_worker, initargs=(config, args))
+    try:
+        # wait for the workers to be set up
+        pool.map(ready, range(processes), chunksize=1)
+        profiler = StageProfiler(memory=False)
+        profiler.start('pool')
+        for result in pool.imap(process_frame, frames):
+            pass
+        profiler.stop()
+    finally:
+        pool.close()
+        pool.join()
+    record = profiler.records[0]
+    return {'seconds': record['wall'], 'cpu': np.NaN, 'peak_memory': np.NaN}
+
+
+def bench_stages(frames, config, args, repeat):
+    '''
+    Time single stages of process_image on all frames. Returns dictionary of the name
+    of the stage and its measurement.
+    '''
+    data = skycam.celObjects_dict(config)
+    crop = skycam.get_crop_mask(frames[0]['img'], config['crop'])
+    observers = []
+    for frame in frames:
+        observer = skycam.obs_setup(config['properties'])
+        observer.date = frame['timestamp']
+        observers.append(observer)
+    # geometry gets set up with the first call
+    skycam.update_star_position(data, observers[0], config, crop, args)
+    results = dict()
+    results['update_star_position'] = measure(
+            lambda: [skycam.update_star_position(data, o, config, crop, args) for o in observers], repeat)
+
+    # star tables with visibility and filter responses of all frames
+    args = dict(args, **{'--ratescan': True})
+    init_worker(config, args)
+    outputs = [process_frame({'img': f['img'].copy(), 'timestamp': f['timestamp']}) for f in frames]
+    shape = frames[0]['img'].shape
+    rng = shape[1] // 80
+    results['calc_cloud_map'] = measure(
+            lambda: [skycam.calc_cloud_map(o['stars'], rng, shape, weight=True) for o in outputs], repeat)
+
+    thresholds = np.logspace(-4.5, -0.5, 200)
+    responses = []
+    for frame, output in zip(frames, outputs):
+        img = frame['img'].copy()
+        img[crop] = np.NaN
+        response = skycam.filterBank(img, [float(config['analysis']['kernelsize'])], 'LoG')[-1]
+        response[crop] = np.NaN
+        responses.append((response, output['stars'].response.values))
+    results['ratescan'] = measure(lambda: [skycam.ratescan(r, s, thresholds) for r, s in responses], repeat)
+    return results
+
+
+def bench_cli(script, name, filenames, processes):
+    '''
+    Time the batch mode of the starry_night script with filenames in a separate process.
+    Returns wall time, CPU time and maximum resident memory of the script and its workers,
+    all NaN and 'failed' True if the script exits with an error.
+    '''
+    log = logging.getLogger('benchmark')
+    command = [sys.executable, script, '-c', name, '--processes={}'.format(processes)] + filenames
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    # wait4 returns the resource usage of this child only
+    stderr = process.stderr.read()
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    seconds = time.perf_counter() - start
+    # the script catches SystemExit and only logs errors
+    if process.returncode != 0 or b'Shutdown due to error' in stderr:
+        log.error('starry_night failed: {}'.format(stderr.decode(errors='replace')[-2000:]))
+        return {'seconds': np.NaN, 'cpu': np.NaN, 'peak_memory': np.NaN, 'max_rss': np.NaN, 'failed': True}
+    return {'seconds': seconds, 'cpu': usage.ru_utime + usage.ru_stime, 'peak_memory': np.NaN,
+            'max_rss': usage.ru_maxrss * 1024}
+
+
+def version():
+    '''
+    Returns the git revision of the repository or the installed version of starry_night
+    '''
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=repository,
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return pkg_resources.require('starry_night')[0].version
+
+
+def main(args):
+    log = logging.getLogger('benchmark')
+    counts = sorted(int(n) for n in args['--images'].split(','))
+    processes = sorted(int(n) for n in args['--processes'].split(','))
+    skip = args['--skip'].split(',') if args['--skip'] else []
+    script = args['--script'] or os.path.join(repository, 'scripts', 'starry_night')
+    start = datetime.strptime(args['--start'], '%Y-%m-%d %H:%M')
+    repeat = int(args['--repeat'])
+
+    rows = []
+    def record(camera, benchmark, images, processes, result):
+        row = dict(result, camera=camera, benchmark=benchmark, images=images, processes=processes)
+        row['failed'] = result.get('failed', False)
+        row['images_per_second'] = images / result['seconds']
+        if row['failed']:
+            log.warning('{:6s} {:22s} {:4d} images {:2d} processes: failed'.format(camera, benchmark, images, processes))
+            rows.append(row)
+            return
+        log.info('{:6s} {:22s} {:4d} images {:2d} processes: {:8.3f}s {:8.2f} images/s'.format(
+            camera, benchmark, images, processes, result['seconds'], row['images_per_second']))
+        rows.append(row)
+
+    for name in args['--cameras'].split(','):
+        try:
+            config = read_config(name)
+        except ValueError as e:
+            log.warning('Skipping camera {}: {}'.format(name, e))
+            continue
+        log.info('Rendering {} synthetic frames of camera {}'.format(counts[-1], name))
+        frames = list(synthetic_frames(config, counts[-1], start, float(args['--cadence']),
+                float(args['--clouds']), float(args['--noise']), int(args['--seed'])))
+        pargs = process_args(name)
+
+        if 'stages' not in skip:
+            for stage, result in bench_stages(frames[:counts[0]], config, pargs, repeat).items():
+                record(name, stage, counts[0], 1, result)
+
+        for n in counts:
+            if 'process_image' not in skip:
+                for p in processes:
+                    record(name, 'process_image', n, p, bench_process_image(frames[:n], config, pargs, p))
+
+        if 'cli' not in skip:
+            with tempfile.TemporaryDirectory() as directory:
+                directory = args['--keep'] or directory
+                os.makedirs(directory, exist_ok=True)
+                filenames = write_frames(frames, directory, config)
+                for n in counts:
+                    for p in processes:
+                        record(name, 'cli', n, p, bench_cli(script, name, filenames[:n], p))
+        del frames
+
+    results = pd.DataFrame(rows, columns=['camera', 'benchmark', 'images', 'processes', 'seconds',
+        'cpu', 'images_per_second', 'peak_memory', 'max_rss', 'failed'])
+    results.insert(0, 'version', version())
+    results.insert(1, 'date', datetime.utcnow().replace(microsecond=0))
+    results['cpus'] = os.cpu_count()
+    exists = os.path.exists(args['--output'])
+    results.to_csv(args['--output'], mode='a', header=not exists, index=False)
+    log.info('Results written to {}'.format(args['--output']))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+            format='%(asctime)s - %(levelname)s - %(name)s | %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S',
+            level=logging.INFO,
+            )
+    # process_image logs every single image and warns about missing cloud maps
+    logging.getLogger('starry_night').setLevel(logging.ERROR)
+    main(docopt(__doc__))
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+
+class StarStatistics:
+    '''
+    Running statistics of all numeric star columns per HIP.
+
+    Star tables of process_image get folded in as they arrive, so the star tables of
+    a whole night never need to be in memory at the same time. Per HIP and column it keeps
+    count, mean and the sum of squared deviations (M2, Welford) and the min/max altitude.
+    Two instances (e.g. of different workers or nights) can be merged with the pairwise
+    update of Chan et al., which does not suffer from cancellation like sum and sum of squares would.
+    '''
+    def __init__(self):
+        self.images = 0
+        self.count = pd.DataFrame()
+        self.mean = pd.DataFrame()
+        self.m2 = pd.DataFrame()
+        self.min_altitude = pd.Series(dtype=float)
+        self.max_altitude = pd.Series(dtype=float)
+
+    def add(self, stars, images=1):
+        '''
+        Fold a star table into the statistics. The index (level) 'HIP' identifies the stars,
+        if there is none the first index level is used.
+        'images' is the number of images the table contains.
+        '''
+        numeric = stars.select_dtypes(include=[np.number])
+        grouped = numeric.groupby(level='HIP' if 'HIP' in numeric.index.names else 0)
+        other = StarStatistics()
+        other.images = images
+        other.count = grouped.count()
+        other.mean = grouped.mean().fillna(0)
+        other.m2 = (grouped.var(ddof=0) * other.count).fillna(0)
+        if 'altitude' in numeric.columns:
+            other.min_altitude = grouped.altitude.min()
+            other.max_altitude = grouped.altitude.max()
+        self.merge(other)
+
+    def merge(self, other):
+        '''
+        Merge the statistics of other into this one
+        '''
+        self.images += other.images
+        if self.count.empty:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min_altitude, self.max_altitude = other.min_altitude, other.max_altitude
+            return
+        if other.count.empty:
+            return
+
+        # align both statistics on HIP and columns
+        n_a, n_b = self.count.align(other.count, fill_value=0)
+        mean_a, mean_b = self.mean.align(other.mean, fill_value=0)
+        m2_a, m2_b = self.m2.align(other.m2, fill_value=0)
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.mean = (mean_a + delta * n_b / n).where(n > 0, 0)
+            self.m2 = (m2_a + m2_b + delta**2 * n_a * n_b / n).where(n > 0, 0)
+        self.count = n
+
+        min_a, min_b = self.min_altitude.align(other.min_altitude)
+        max_a, max_b = self.max_altitude.align(other.max_altitude)
+        self.min_altitude = pd.Series(np.fmin(min_a.values, min_b.values), index=min_a.index)
+        self.max_altitude = pd.Series(np.fmax(max_a.values, max_b.values), index=max_a.index)
+
+    def frequent(self, min_images=0.5):
+        '''
+        Returns boolean Series that is True for all stars that were found in more than
+        min_images images. If min_images < 1 it is the fraction of all images.
+        '''
+        if min_images < 1:
+            min_images = min_images * self.images
+        return self.count.max(axis=1) > min_images
+
+    def mean_std(self, min_images=0.5):
+        '''
+        Returns mean and std (ddof=1) of all numeric columns of every star that was found
+        in more than min_images images (see frequent)
+        '''
+        mean = self.mean.where(self.count > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.sqrt(self.m2 / (self.count - 1)).where(self.count > 1)
+        keep = self.frequent(min_images).values
+        return mean[keep], std[keep]
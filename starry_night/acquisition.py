@@ -0,0 +1,125 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from requests.exceptions import RequestException
+
+from starry_night import skycam, forecast, plotting
+from starry_night.cloud_tracker import CloudTracker
+from starry_night.profiling import RunProfile
+
+# per camera state of a worker process, see init_worker
+context = dict()
+
+
+class Camera:
+    '''
+    Everything the acquisition service needs to know about one camera:
+    its config, celestial objects (see skycam.celObjects_dict), download state,
+    cloud tracker and latest forecast of the points of interest (if track is True)
+    '''
+    def __init__(self, config, data, track=False):
+        self.config = config
+        self.data = data
+        self.name = config['properties']['name']
+        self.state = skycam.CameraState(config['properties']['url'])
+        self.processed = 0
+        self.tracker = CloudTracker(config['image']) if track else None
+        self.forecast = None
+        # the forecast projects the points of interest in this process
+        if track and 'geometry' not in data:
+            data['geometry'] = skycam.SkyGeometry(data['stars'], config, skycam.obs_setup(config['properties']))
+
+
+def init_worker(configs, args):
+    '''
+    Initialize a worker process once with the config and celestial objects of all cameras
+    (by name), so tasks only contain the image. Geometry and cloud mapper of a camera that
+    process_image sets up stay in the worker for the next images.
+    '''
+    context['args'] = args
+    context['configs'] = configs
+    context['data'] = dict()
+    for name, config in configs.items():
+        context['data'][name] = skycam.celObjects_dict(config)
+        if args['-p']:
+            context['data'][name]['positioning_file'] = skycam.load_positioning(args['-p'])
+
+
+def process_image(name, img):
+    return skycam.process_image(img, context['data'][name], context['configs'][name], context['args'])
+
+
+async def watch(camera, args, downloader, pool, renderer, profile, interval=30, timeout=5):
+    '''
+    Poll the url of camera forever and hand every new image to the process pool.
+
+    Downloads run in the 'downloader' thread pool, so all cameras can wait for
+    their servers at the same time. Images of one camera are processed one after
+    another, images of different cameras in parallel. Plots get handed to 'renderer'
+    (see plotting.Renderer), so they don't delay the next image. Stage timings get added
+    to 'profile' (RunProfile).
+    '''
+    log = logging.getLogger(__name__)
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            img = await loop.run_in_executor(
+                    downloader, skycam.downloadImg, camera.state.url, timeout, camera.state)
+        except skycam.TooEarlyError:
+            log.debug('{}: No new image available'.format(camera.name))
+            await asyncio.sleep(interval)
+            continue
+        except RequestException as e:
+            log.error('{}: Download of image failed. Try again in {} s. {}'.format(camera.name, interval, e))
+            await asyncio.sleep(interval)
+            continue
+
+        try:
+            output = await loop.run_in_executor(pool, process_image, camera.name, img)
+            camera.processed += 1
+        except Exception as e:
+            log.exception('{}: Processing of image taken at {} failed: {}'.format(camera.name, img['timestamp'], e))
+            output = None
+
+        if output:
+            renderer.submit(output.pop('plot', None))
+            profile.add(output.get('profile', []))
+
+        if camera.tracker is not None and output and 'cloudmap' in output:
+            camera.tracker.update(output['cloudmap'], output['timestamp'])
+            camera.forecast = forecast.forecast_camera(camera.tracker, camera.data, camera.config)
+            log.info('{}: {} clouds in the sky. Forecast of star percentage:\n{}'.format(
+                camera.name, len(camera.tracker.clouds), camera.forecast.dropna(how='all').round(2)))
+
+        # a new image might already be there, so don't wait
+        await asyncio.sleep(0)
+
+
+def run(cameras, args, interval=30, timeout=5, processes=None, plot_interval=0):
+    '''
+    Watch all cameras concurrently until interrupted.
+    Plots of all cameras get rendered in one thread, plots of a file that was written
+    less than 'plot_interval' seconds ago get skipped.
+    With --profile the stage timings of all images get written when the daemon stops.
+    '''
+    log = logging.getLogger(__name__)
+    log.info('Watching cameras: {}'.format(', '.join(c.name for c in cameras)))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    renderer = plotting.Renderer(min_interval=plot_interval, max_pending=4*len(cameras))
+    profile = RunProfile()
+    with ThreadPoolExecutor(max_workers=len(cameras)) as downloader, \
+            ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                initargs=({c.name: c.config for c in cameras}, args)) as pool:
+        try:
+            loop.run_until_complete(asyncio.gather(*[
+                watch(camera, args, downloader, pool, renderer, profile, interval=interval, timeout=timeout)
+                for camera in cameras
+            ]))
+        finally:
+            loop.close()
+            renderer.close()
+            if args['--profile'] and profile.records:
+                profile.write(args['--profile'])
+                log.info('Profile of {} images written to {}'.format(len(profile.frame().timestamp.unique()), args['--profile']))
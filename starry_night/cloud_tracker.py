@@ -1,6 +1,7 @@
 import numpy as np
-import matplotlib as plt
-from skimage.segmentation import active_contour
+import logging
+from scipy import ndimage
+
 
 class Cloud:
     def __init__(self, _id):
@@ -10,10 +11,14 @@ class Cloud:
         self.speed = None
         self.direction = None
         self.covered = True     #if False, then this is not a cloud but a free spot in a covered sky
+        self.velocity = (0., 0.)    # (vx, vy) in pixel per minute
+        self.area = 0
+        self.missed = 0             # number of updates the cloud was not found
 
     def print_info(self):
         print('''Cloud {}:\nID:{}\nHeight:{}\nPosition:{}\nSpeed:{}\n
                 Direction:{}\nCovered:{}'''.format(
+                    self.id,
                     self.id,
                     self.height,
                     self.position,
@@ -23,37 +28,322 @@ class Cloud:
                     )
         )
 
+    def set_velocity(self, vx, vy):
+        '''
+        Set velocity in pixel per minute, speed and direction (radians, image coordinates) follow from it
+        '''
+        self.velocity = (float(vx), float(vy))
+        self.speed = float(np.hypot(vx, vy))
+        self.direction = float(np.arctan2(vy, vx))
+
+
+def block_sums(x, block, step):
+    '''
+    Returns sums of x (last two axes) in windows of block x block cells every step cells
+    '''
+    c = np.zeros(x.shape[:-2] + (x.shape[-2]+1, x.shape[-1]+1))
+    c[..., 1:, 1:] = x.cumsum(axis=-2).cumsum(axis=-1)
+    r = np.arange(0, x.shape[-2]-block+1, step)[:, np.newaxis]
+    q = np.arange(0, x.shape[-1]-block+1, step)
+    return c[..., r+block, q+block] - c[..., r, q+block] - c[..., r+block, q] + c[..., r, q]
+
+
+def block_matching(previous, current, weights, block, step, max_shift):
+    '''
+    Returns displacement (dy, dx) of every block (size block x block, every step cells)
+    of current relative to previous and the mean squared difference at this displacement.
+
+    All integer shifts up to max_shift get tested for all blocks at once using window sums of
+    the weighted squared differences. The minimum gets refined to subpixel precision with a parabola.
+    weights: weight of every cell, e.g. 0 outside of the sky
+    '''
+    m = max_shift
+    padded = np.pad(previous, m, mode='edge')
+    paddedWeights = np.pad(weights, m, mode='constant')
+    h, w = current.shape
+    shifts = np.arange(-m, m+1)
+
+    ssd = np.empty((len(shifts), len(shifts)) + block_sums(current, block, step).shape)
+    for i, dy in enumerate(shifts):
+        for j, dx in enumerate(shifts):
+            # current(p) = previous(p - d)
+            shifted = padded[m-dy:m-dy+h, m-dx:m-dx+w]
+            weight = weights * paddedWeights[m-dy:m-dy+h, m-dx:m-dx+w]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ssd[i, j] = block_sums(weight * (current - shifted)**2, block, step) / block_sums(weight, block, step)
+    ssd[~np.isfinite(ssd)] = np.inf
+
+    flat = ssd.reshape((-1,) + ssd.shape[2:])
+    best = flat.argmin(axis=0)
+    iy, ix = np.unravel_index(best, ssd.shape[:2])
+    minimum = np.take_along_axis(flat, best[np.newaxis], axis=0)[0]
+
+    def refine(i, axis):
+        # parabola through the minimum and its neighbours along axis
+        lo, hi = np.maximum(i-1, 0), np.minimum(i+1, len(shifts)-1)
+        index = [iy, ix]
+        index[axis] = lo
+        left = np.take_along_axis(flat, np.ravel_multi_index(index, ssd.shape[:2])[np.newaxis], axis=0)[0]
+        index[axis] = hi
+        right = np.take_along_axis(flat, np.ravel_multi_index(index, ssd.shape[:2])[np.newaxis], axis=0)[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset = 0.5 * (left - right) / (left - 2*minimum + right)
+        return np.clip(np.nan_to_num(offset, nan=0, posinf=0, neginf=0), -0.5, 0.5)
+
+    return shifts[iy] + refine(iy, 0), shifts[ix] + refine(ix, 1), minimum
+
+
 class CloudTracker:
-    def __init__(self):
+    '''
+    Tracks clouds in successive cloud maps (see skycam.calc_cloud_map) and forecasts them.
+
+    Every update the cloud map gets averaged on a coarse grid (one cell per 'factor' pixels,
+    default: 160 cells per image row).
+    A dense motion field is estimated by block matching of overlapping blocks of the
+    previous and current grid (all blocks at once for every tested shift). Blocks without structure
+    get the median motion of all other blocks. Cloud regions (cloudiness > threshold) are labeled and matched
+    to the clouds of the last update by their predicted position.
+    The forecast moves the last cloud map along the motion field (semi-Lagrangian).
+
+    Only the last grid, the motion field and the current clouds are kept, so memory does not grow
+    with the number of updates.
+
+    config: section 'image' of the camera config (zenith_x, zenith_y and radius define the sky),
+        pixels outside the sky don't take part in motion estimation
+    '''
+    def __init__(self, config=None, threshold=0.5, factor=None, block=32, step=16, min_area=4,
+            max_gap=15, max_missed=2, max_clouds=100, smoothing=0.5, max_speed=20):
         self.clouds = []
         self.maxID = -1
         self.wind_speed = None
         self.wind_direction = None
 
+        self.config = config
+        self.threshold = threshold
+        self.factor = factor
+        self.block = block
+        self.step = step
+        self.min_area = min_area
+        self.max_gap = max_gap
+        self.max_missed = max_missed
+        self.max_clouds = max_clouds
+        self.smoothing = smoothing
+        self.max_speed = max_speed      # pixel per minute
+
+        self.grid = None
+        self.sky = None
+        self.cloudmap = None
+        self.timestamp = None
+        self.field = None       # (vy, vx) per block in pixel per minute
+
     def add_cloud(self):
-        self.add_cloud(self, self.maxID + 1)
         self.maxID += 1
+        cloud = Cloud(self.maxID)
+        self.clouds.append(cloud)
+        return cloud
 
     def remove_cloud(self, _id):
-        popped = False
-        for i in enumerate(clouds):
-            if clouds[i].id == _id:
-                clouds.pop(i)
-                popped = True
-                break
-        if not popped:
-            raise IndexError('No Cloud with id={} in CloudTracker!'.format(_id))
+        for i, cloud in enumerate(self.clouds):
+            if cloud.id == _id:
+                self.clouds.pop(i)
+                return
+        raise IndexError('No Cloud with id={} in CloudTracker!'.format(_id))
 
     def print_clouds(self):
         print('Currently {} clouds in the sky'.format(len(self.clouds)))
-        for c in enumerate(self.clouds):
+        for c in self.clouds:
             c.print_info()
 
+    def sky_mask(self, shape):
+        '''
+        Returns boolean array (True = sky) in size of shape from the camera config
+        '''
+        if self.config is None:
+            return np.ones(shape, dtype=bool)
+        row, col = np.ogrid[:shape[0], :shape[1]]
+        x = float(self.config['zenith_x'])
+        y = float(self.config['zenith_y'])
+        r = float(self.config['radius'])
+        return (row - y)**2 + (col - x)**2 < r**2
+
+    def downsample(self, img):
+        '''
+        Returns mean of img in blocks of factor x factor pixels (edges are cut off)
+        '''
+        f = self.factor
+        h, w = img.shape[0]//f, img.shape[1]//f
+        return img[:h*f, :w*f].reshape(h, f, w, f).mean(axis=(1, 3))
+
     # update detects clouds in cloudmap and updates old cloud positions
-    def update(self, cloudMap):
-        # detect clouds
-        snake = active_contour(cloudMap, init, alpha=0.015, beta=10, gamma=0.001)
+    def update(self, cloudMap, timestamp):
+        '''
+        Add the cloud map of an image taken at timestamp (datetime)
+        '''
+        log = logging.getLogger(__name__)
+        cloudMap = np.asarray(cloudMap, dtype=float)
+        if self.sky is None or self.sky.shape != cloudMap.shape:
+            # about 160 grid cells per image row
+            self.factor = self.factor or max(1, cloudMap.shape[1]//160)
+            self.sky = self.sky_mask(cloudMap.shape)
+            self.skyGrid = self.downsample(self.sky.astype(float)) > 0.5
+            self.grid = None
+
+        grid = self.downsample(np.where(self.sky, np.nan_to_num(cloudMap), 0))
+        if self.grid is not None:
+            dt = (timestamp - self.timestamp).total_seconds() / 60
+            if 0 < dt <= self.max_gap:
+                self.update_motion(self.grid, grid, dt)
+            else:
+                log.debug('Time between cloud maps is {} min, motion is not updated'.format(dt))
+                dt = None
+        else:
+            dt = None
+
+        self.update_clouds(grid, dt)
+        self.grid = grid
+        self.cloudmap = cloudMap
+        self.timestamp = timestamp
+
+    def update_motion(self, previous, current, dt):
+        '''
+        Estimate motion field between two grids dt minutes apart
+        '''
+        size = min(self.block, *current.shape)
+        maxShift = int(min(size//2, np.ceil(self.max_speed * dt / self.factor)))
+        # everything that is not sky does not move and must not take part
+        dy, dx, _ = block_matching(previous, current, self.skyGrid.astype(float), size, self.step, maxShift)
+        field = np.stack([dy, dx]) * self.factor / dt
+
+        # blocks without sky or structure get the median motion of all other blocks
+        validity = block_sums(self.skyGrid.astype(float), size, self.step) / size**2
+        mean = block_sums(current, size, self.step) / size**2
+        texture = np.sqrt(np.maximum(block_sums(current**2, size, self.step) / size**2 - mean**2, 0))
+        reliable = (validity > 0.5) & (texture > 0.02)
+        if reliable.any():
+            wind = np.median(field[:, reliable], axis=1)
+        elif self.field is not None:
+            wind = np.median(self.field.reshape(2, -1), axis=1)
+        else:
+            wind = np.zeros(2)
+        field[:, ~reliable] = wind[:, np.newaxis]
 
+        if self.field is None or self.field.shape != field.shape:
+            self.field = field
+        else:
+            self.field = self.smoothing * field + (1 - self.smoothing) * self.field
+
+        vy, vx = np.median(self.field.reshape(2, -1), axis=1)
+        self.wind_speed = float(np.hypot(vx, vy))
+        self.wind_direction = float(np.arctan2(vy, vx))
+
+    def velocity_at(self, x, y):
+        '''
+        Returns motion field (vx, vy) in pixel per minute at pixel positions x, y
+        '''
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if self.field is None:
+            return np.zeros_like(x), np.zeros_like(y)
+        # block i has its center at grid cell i*step + block/2
+        size = min(self.block, *self.grid.shape)
+        coords = [(y / self.factor - size/2) / self.step, (x / self.factor - size/2) / self.step]
+        vy = ndimage.map_coordinates(self.field[0], coords, order=1, mode='nearest')
+        vx = ndimage.map_coordinates(self.field[1], coords, order=1, mode='nearest')
+        return vx, vy
+
+    def update_clouds(self, grid, dt):
+        '''
+        Label cloud regions in grid and match them with the known clouds
+        '''
+        labels, n = ndimage.label((grid > self.threshold) & self.skyGrid)
+        area = np.bincount(labels.ravel(), minlength=n+1)[1:]
+        rows, cols = np.indices(grid.shape)
+        cy = np.bincount(labels.ravel(), rows.ravel(), minlength=n+1)[1:] / np.maximum(area, 1)
+        cx = np.bincount(labels.ravel(), cols.ravel(), minlength=n+1)[1:] / np.maximum(area, 1)
+
+        # keep the largest regions only, centers in pixel
+        regions = np.flatnonzero(area >= self.min_area)
+        regions = regions[np.argsort(area[regions])[::-1][:self.max_clouds]]
+        x = (cx[regions] + 0.5) * self.factor
+        y = (cy[regions] + 0.5) * self.factor
+        vx, vy = self.velocity_at(x, y)
+
+        # match predicted positions of known clouds to the regions, closest pairs first
+        matched = np.zeros(len(regions), dtype=bool)
+        found = set()
+        if self.clouds and len(regions) and dt is not None:
+            px = np.array([c.position[0] + c.velocity[0]*dt for c in self.clouds])
+            py = np.array([c.position[1] + c.velocity[1]*dt for c in self.clouds])
+            distance = np.hypot(px[:, np.newaxis] - x, py[:, np.newaxis] - y)
+            maxDistance = self.block * self.factor / 2
+            for i, j in zip(*np.unravel_index(np.argsort(distance, axis=None), distance.shape)):
+                if distance[i, j] > maxDistance:
+                    break
+                if i in found or matched[j]:
+                    continue
+                cloud = self.clouds[i]
+                # velocity of the cloud itself, smoothed with the motion field
+                ownX = (x[j] - cloud.position[0]) / dt
+                ownY = (y[j] - cloud.position[1]) / dt
+                cloud.set_velocity(0.5*(ownX + vx[j]), 0.5*(ownY + vy[j]))
+                cloud.position = (float(x[j]), float(y[j]))
+                cloud.area = int(area[regions[j]]) * self.factor**2
+                cloud.missed = 0
+                found.add(i)
+                matched[j] = True
+
+        # clouds that were not found get moved with their velocity and removed after some time
+        for i, cloud in enumerate(self.clouds):
+            if i not in found:
+                cloud.missed += 1
+                if dt is not None:
+                    cloud.position = (cloud.position[0] + cloud.velocity[0]*dt, cloud.position[1] + cloud.velocity[1]*dt)
+        self.clouds = [c for c in self.clouds if c.missed <= self.max_missed]
+
+        for j in np.flatnonzero(~matched):
+            if len(self.clouds) >= self.max_clouds:
+                break
+            cloud = self.add_cloud()
+            cloud.position = (float(x[j]), float(y[j]))
+            cloud.area = int(area[regions[j]]) * self.factor**2
+            cloud.set_velocity(vx[j], vy[j])
 
+    def forecast_at(self, x, y, minutes):
+        '''
+        Returns forecasted cloudiness 'minutes' ahead of the last update at pixel positions x, y.
+        x, y and minutes get broadcast against each other, so tracks of many positions
+        can be forecasted in one call.
+        '''
+        if self.cloudmap is None:
+            raise ValueError('No cloud map available, call update() first')
+        x, y, minutes = np.broadcast_arrays(
+                np.asarray(x, dtype=float), np.asarray(y, dtype=float), np.asarray(minutes, dtype=float))
+        vx, vy = self.velocity_at(x, y)
+        # value at position p comes from p - v*t (semi-Lagrangian)
+        coords = [y - vy*minutes, x - vx*minutes]
+        return ndimage.map_coordinates(self.cloudmap, coords, order=1, mode='nearest')
 
+    def forecast(self, minutes):
+        '''
+        Returns cloud map of the last update moved 'minutes' ahead along the motion field
+        '''
+        if self.cloudmap is None:
+            raise ValueError('No cloud map available, call update() first')
+        if self.field is None or minutes == 0:
+            return self.cloudmap.copy()
+        rows, cols = np.indices(self.cloudmap.shape, dtype=float)
+        return self.forecast_at(cols, rows, minutes)
 
+    def coverage(self, x, y, minutes, radius=0):
+        '''
+        Returns forecasted cloudiness 'minutes' ahead at pixel positions x, y.
+        If radius > 0 (pixel) the mean cloudiness within radius is returned.
+        '''
+        forecast = self.forecast(minutes)
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        if radius > 0:
+            # mean within radius is a convolution with a normalized disk
+            disk = np.add.outer(np.arange(-int(radius), int(radius)+1)**2, np.arange(-int(radius), int(radius)+1)**2) <= radius**2
+            forecast = ndimage.convolve(forecast, disk / disk.sum(), mode='nearest')
+        return ndimage.map_coordinates(forecast, [y, x], order=1, mode='nearest')
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+from starry_night import skycam
+
+
+# sidereal time advances 1.0027379 times faster than solar time
+SIDEREAL_RATE = 2*np.pi * 1.00273790935 / (24*60)   # radians per minute
+
+
+def sidereal_time(config, timestamp):
+    '''
+    Returns local sidereal time in radians at the site of the camera for timestamp
+    '''
+    observer = skycam.obs_setup(config['properties'])
+    observer.date = timestamp
+    return float(observer.sidereal_time())
+
+
+def poi_tracks(points_of_interest, geometry, sidereal_time, minutes):
+    '''
+    Returns azimuth, altitude, x and y of every point of interest (rows) at every time
+    'minutes' after sidereal_time (columns). ra and dec of points_of_interest in radians.
+    '''
+    st = sidereal_time + SIDEREAL_RATE * np.asarray(minutes, dtype=float)
+    return geometry.project(
+            points_of_interest.ra.values[:, np.newaxis],
+            points_of_interest.dec.values[:, np.newaxis],
+            st[np.newaxis, :],
+    )
+
+
+def disc_samples(azimuth, altitude, radius, samples=32):
+    '''
+    Returns azimuth and altitude of 'samples' points that cover a disc with angular radius
+    (radians) around every position evenly (sunflower pattern). Output has an additional last axis.
+    '''
+    k = np.arange(samples)
+    distance = np.asarray(radius, dtype=float)[..., np.newaxis] * np.sqrt((k + 0.5) / samples)
+    bearing = k * np.pi * (3 - np.sqrt(5))
+
+    alt = np.asarray(altitude, dtype=float)[..., np.newaxis]
+    az = np.asarray(azimuth, dtype=float)[..., np.newaxis]
+    sampleAlt = np.arcsin(np.clip(np.sin(alt)*np.cos(distance) + np.cos(alt)*np.sin(distance)*np.cos(bearing), -1, 1))
+    sampleAz = az + np.arctan2(np.sin(bearing)*np.sin(distance)*np.cos(alt),
+            np.cos(distance) - np.sin(alt)*np.sin(sampleAlt))
+    return sampleAz, sampleAlt
+
+
+def forecast_star_percentages(tracker, points_of_interest, geometry, sidereal_time,
+        minutes=np.arange(0, 31, 5), crop=None, samples=32):
+    '''
+    Predict the percentage of visible stars around every point of interest for the next minutes.
+
+    The sky track of every point of interest gets projected into the image at all forecast times
+    at once. The cloudiness (see cloud_tracker.CloudTracker.forecast_at) is sampled evenly within
+    the radius (degrees, column 'radius') of every point of interest. Samples below the altitude
+    limit, outside of the image or in the cropped area (crop, see skycam.get_crop_mask) are ignored.
+
+    tracker: CloudTracker that was updated with the latest cloud map
+    sidereal_time: sidereal time (radians) of the latest cloud map
+    minutes: forecast times in minutes after the latest cloud map
+
+    Returns: DataFrame with one row per point of interest (same index) and one column per
+        forecast time. NaN if the point of interest is not observable.
+    '''
+    minutes = np.atleast_1d(np.asarray(minutes, dtype=float))
+    az, alt, _, _ = poi_tracks(points_of_interest, geometry, sidereal_time, minutes)
+    radius = np.deg2rad(points_of_interest.radius.values)[:, np.newaxis] * np.ones_like(alt)
+    sampleAz, sampleAlt = disc_samples(az, alt, radius, samples)
+    x, y = geometry.horizontal2image(sampleAz, sampleAlt)
+
+    res = geometry.resolution
+    valid = (sampleAlt > geometry.min_altitude) & (0 < x) & (x < res[0]) & (0 < y) & (y < res[1])
+    if crop is not None:
+        valid[valid] = ~skycam.isCropped(crop, x[valid], y[valid])
+
+    cloudiness = np.where(valid, tracker.forecast_at(x, y, minutes[np.newaxis, :, np.newaxis]), np.NaN)
+    with np.errstate(invalid='ignore'):
+        count = valid.sum(axis=-1)
+        percentage = 1 - np.nansum(cloudiness, axis=-1) / count
+    # the point of interest itself has to be observable
+    percentage[(count == 0) | (alt <= geometry.min_altitude)] = np.NaN
+    return pd.DataFrame(percentage, index=points_of_interest.index, columns=pd.Index(minutes, name='minutes'))
+
+
+def forecast_camera(tracker, data, config, minutes=np.arange(0, 31, 5)):
+    '''
+    Forecast star percentages of all points of interest of a camera for the latest cloud map
+    of tracker. data is the dictionary of skycam.celObjects_dict.
+
+    Returns: DataFrame indexed by the names of the points of interest, see forecast_star_percentages
+    '''
+    points_of_interest = data['points_of_interest']
+    percentages = forecast_star_percentages(
+            tracker,
+            points_of_interest,
+            data['geometry'],
+            sidereal_time(config, tracker.timestamp),
+            minutes,
+            crop=skycam.get_crop_mask(tracker.cloudmap, config['crop']),
+    )
+    percentages.index = points_of_interest.name.values
+    return percentages
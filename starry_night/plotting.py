@@ -0,0 +1,297 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from matplotlib import cm
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from mpl_toolkits.axes_grid.inset_locator import inset_axes
+
+
+def plot_record(img, stars, points_of_interest, cloud_map, config, args, timestamp):
+    '''
+    Returns everything the plots of one image need, so they can be rendered somewhere else
+    (see Renderer and show), or None if no plot was requested.
+
+    'targets' is a list of (kind, filename, dpi) of all requested plots,
+    filename is None if the plot should be shown interactively (-v).
+    '''
+    name = config['properties']['name']
+    isotime = timestamp.isoformat()
+    targets = []
+    if args['--cam'] or args['--daemon']:
+        if args['-s']:
+            targets.append(('cam', 'cam_image_{}.pdf'.format(isotime), None))
+        if args['--daemon']:
+            targets.append(('cam', 'cam_image_{}.png'.format(name), 300))
+        if args['-v']:
+            targets.append(('cam', None, None))
+    if (args['--single'] and args['--response']) or args['--daemon']:
+        if args['-s']:
+            targets.append(('response', 'response_{}_{}.png'.format(args['--function'], isotime), None))
+        if args['--daemon']:
+            targets.append(('response', 'response_{}.png'.format(name), 200))
+        if args['-v']:
+            targets.append(('response', None, None))
+    if cloud_map is not None:
+        if args['--cloudmap'] and args['-s']:
+            targets.append(('cloudmap', 'cloudMap_{}.png'.format(isotime), None))
+        if args['--cloudmap'] and args['-v']:
+            targets.append(('cloudmap', None, None))
+        if args['--daemon']:
+            targets.append(('cloudmap_only', 'cloudMap_{}.png'.format(name), 200))
+    if not targets:
+        return None
+
+    return {
+        'timestamp': timestamp,
+        'targets': targets,
+        'img': img.astype(np.float32),
+        'stars': stars[['x', 'y', 'vmag', 'response', 'visible']].copy(),
+        'points_of_interest': points_of_interest[['x', 'y']].copy(),
+        'cloud_map': None if cloud_map is None else cloud_map.astype(np.float32),
+        'upper_limit': [float(l) for l in config['analysis']['visibleupperlimit'].split(',')],
+        'lower_limit': [float(l) for l in config['analysis']['visiblelowerlimit'].split(',')],
+        'function': args['--function'],
+        'camera': args['-c'],
+    }
+
+
+def positions(x, y):
+    return np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+
+
+class CamPlot:
+    '''
+    Camera image with the visibility of all stars and the points of interest.
+    All plots create their artists with the first record and only update their data afterwards.
+    '''
+    figsize = (16, 9)
+
+    def __init__(self, figure):
+        self.figure = figure
+        self.ax = figure.add_subplot(111)
+        self.image = None
+
+    def draw(self, record):
+        img, stars, poi = record['img'], record['stars'], record['points_of_interest']
+        vmin, vmax = np.nanpercentile(img, [5, 90])
+        if self.image is None:
+            self.image = self.ax.imshow(img, vmin=vmin, vmax=vmax, cmap='gray')
+            self.stars = self.ax.scatter(stars.x.values, stars.y.values, c=stars.visible.values,
+                    cmap=cm.RdYlGn, s=30, vmin=0, vmax=1)
+            self.sources = self.ax.scatter(poi.x.values, poi.y.values, s=80, color='white', marker='^', label='Sources')
+            self.ax.grid()
+            self.figure.colorbar(self.stars, ax=self.ax)
+            self.figure.tight_layout()
+            return
+        self.image.set_data(img)
+        self.image.set_clim(vmin, vmax)
+        self.stars.set_offsets(positions(stars.x.values, stars.y.values))
+        self.stars.set_array(stars.visible.values)
+        self.sources.set_offsets(positions(poi.x.values, poi.y.values))
+
+
+class ResponsePlot:
+    '''
+    Response vs magnitude of all stars with the visibility limits and the camera image as inset
+    '''
+    figsize = (16, 9)
+
+    def __init__(self, figure):
+        self.figure = figure
+        self.ax = figure.add_subplot(111)
+        self.scatter = None
+
+    def draw(self, record):
+        img, stars = record['img'], record['stars']
+        upper, lower = record['upper_limit'], record['lower_limit']
+        x = np.linspace(-5+stars.vmag.min(), stars.vmag.max()+5, 20)
+        vmin, vmax = np.nanpercentile(img, [0.5, 99.])
+        if self.scatter is None:
+            ax = self.ax
+            ax.semilogy()
+            self.lower, = ax.plot(x, 10**(x*lower[0] + lower[1]), c='red', label='lower limit')
+            self.upper, = ax.plot(x, 10**(x*upper[0] + upper[1]), c='green', label='upper limit')
+            self.scatter = ax.scatter(stars.vmag.values, stars.response.values, c=stars.visible.values,
+                    cmap=cm.RdYlGn, vmin=0, vmax=1, label='Kernel Response')
+            ax.grid()
+            ax.set_ylabel('Kernel Response')
+            ax.set_xlabel('Star Magnitude')
+            if record['camera'] == 'GTC':
+                if record['function'] == 'Grad':
+                    ax.axhspan(ymin=11**2/255**2, ymax=13**2/255**2, color='red', alpha=0.5, label='old threshold range')
+                ax.axvline(4.5, color='black', label='Magnitude lower limit')
+            ax.legend(loc='best')
+
+            # show camera image in a subplot
+            self.inset = inset_axes(ax, width='30%', height='40%', loc=3)
+            self.image = self.inset.imshow(img, cmap='gray', vmin=vmin, vmax=vmax)
+            self.stars = self.inset.scatter(stars.x.values, stars.y.values, c=stars.visible.values,
+                    cmap=cm.RdYlGn, vmin=0, vmax=1)
+            self.inset.get_xaxis().set_visible(False)
+            self.inset.get_yaxis().set_visible(False)
+        else:
+            self.lower.set_data(x, 10**(x*lower[0] + lower[1]))
+            self.upper.set_data(x, 10**(x*upper[0] + upper[1]))
+            self.scatter.set_offsets(positions(stars.vmag.values, stars.response.values))
+            self.scatter.set_array(stars.visible.values)
+            self.image.set_data(img)
+            self.image.set_clim(vmin, vmax)
+            self.stars.set_offsets(positions(stars.x.values, stars.y.values))
+            self.stars.set_array(stars.visible.values)
+        self.ax.set_xlim((-1, stars.vmag.max()+0.5))
+        self.ax.set_ylim((10**(lower[1]-1), 10**(upper[1]+1)))
+
+
+class CloudMapPlot:
+    '''
+    Camera image next to its cloud map
+    '''
+    figsize = (6.4, 4.8)
+    with_image = True
+
+    def __init__(self, figure):
+        self.figure = figure
+        self.map = None
+
+    def draw(self, record):
+        if self.map is None:
+            if self.with_image:
+                self.ax_img = self.figure.add_subplot(121)
+                self.image = self.ax_img.imshow(record['img'], cmap='gray', interpolation='none')
+                self.ax_img.grid()
+                self.ax_map = self.figure.add_subplot(122)
+            else:
+                self.ax_map = self.figure.add_subplot(111)
+            self.map = self.ax_map.imshow(record['cloud_map'], cmap='gray_r', vmin=0, vmax=1)
+            self.ax_map.grid()
+        else:
+            self.map.set_data(record['cloud_map'])
+            if self.with_image:
+                self.image.set_data(record['img'])
+        if self.with_image:
+            self.image.set_clim(*np.nanpercentile(record['img'], [5.5, 99.9]))
+
+
+class CloudMapOnlyPlot(CloudMapPlot):
+    '''
+    Cloud map without camera image
+    '''
+    with_image = False
+
+
+PLOTS = {
+    'cam': CamPlot,
+    'response': ResponsePlot,
+    'cloudmap': CloudMapPlot,
+    'cloudmap_only': CloudMapOnlyPlot,
+}
+
+
+def show(record):
+    '''
+    Show all plots of record that have no filename with pyplot. Blocks until all windows are closed.
+    '''
+    import matplotlib.pyplot as plt
+    for kind, filename, dpi in record['targets']:
+        if filename is None:
+            PLOTS[kind](plt.figure(figsize=PLOTS[kind].figsize)).draw(record)
+    plt.show()
+    plt.close('all')
+
+
+class Renderer:
+    '''
+    Renders the plots of plot records (see plot_record) to files in a background thread,
+    so plotting does not add to the latency of the analysis.
+
+    Figures are drawn with the Agg canvas without pyplot, there is one figure per camera, kind of plot
+    and image shape and only the data of its artists gets updated for the next record.
+    A pending plot gets replaced if a newer record for the same file arrives. If more than
+    'max_pending' plots are pending, the oldest gets skipped (or submit waits if 'block' is True).
+    Plots of a file that was rendered less than 'min_interval' seconds ago get skipped.
+    '''
+    def __init__(self, min_interval=0, max_pending=8, block=False):
+        self.min_interval = min_interval
+        self.max_pending = max_pending
+        self.block = block
+        self.pending = OrderedDict()
+        self.last_render = dict()
+        self.plots = dict()
+        self.rendered = 0
+        self.skipped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='renderer', daemon=True)
+        self.thread.start()
+
+    def submit(self, record):
+        '''
+        Queue all plots of record that have a filename
+        '''
+        if not record:
+            return
+        log = logging.getLogger(__name__)
+        with self.condition:
+            for kind, filename, dpi in record['targets']:
+                if filename is None:
+                    continue
+                key = (kind, filename)
+                if key in self.pending:
+                    del self.pending[key]
+                    self.skipped += 1
+                while self.block and len(self.pending) >= self.max_pending and self.thread.is_alive():
+                    self.condition.wait()
+                if len(self.pending) >= self.max_pending:
+                    skipped, _ = self.pending.popitem(last=False)
+                    self.skipped += 1
+                    log.debug('Renderer is busy, skipping plot {}'.format(skipped[1]))
+                self.pending[key] = (record, dpi)
+            self.condition.notify_all()
+
+    def run(self):
+        log = logging.getLogger(__name__)
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                (kind, filename), (record, dpi) = self.pending.popitem(last=False)
+                self.condition.notify_all()
+
+            if time.time() - self.last_render.get((record['camera'], kind, filename), -np.inf) < self.min_interval:
+                self.skipped += 1
+                continue
+            try:
+                self.render(kind, record, filename, dpi)
+            except Exception as e:
+                log.exception('Rendering {} failed: {}'.format(filename, e))
+
+    def render(self, kind, record, filename, dpi=None):
+        '''
+        Draw record into the figure of kind and save it to filename
+        '''
+        # artists like the image extent and the visibility limits depend on the camera
+        key = (record['camera'], kind, record['img'].shape)
+        if key not in self.plots:
+            figure = Figure(figsize=PLOTS[kind].figsize)
+            FigureCanvasAgg(figure)
+            self.plots[key] = PLOTS[kind](figure)
+        plot = self.plots[key]
+        plot.draw(record)
+        plot.figure.savefig(filename, dpi=dpi)
+        self.last_render[(record['camera'], kind, filename)] = time.time()
+        self.rendered += 1
+
+    def close(self):
+        '''
+        Render all pending plots and stop the thread
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
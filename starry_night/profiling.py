@@ -0,0 +1,124 @@
+import json
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+
+class StageProfiler:
+    '''
+    Records wall time, CPU time and peak memory of consecutive stages of processing one image.
+
+    start(name) ends the running stage and starts the next one, stop() ends the last one, so
+    instrumented code does not need extra indentation. A disabled profiler does nothing.
+    Peak memory is the maximum of memory allocated (tracemalloc, includes numpy arrays) during the
+    stage above the memory allocated when the stage started. tracemalloc slows down allocations,
+    so profiling is opt-in and close() stops tracing if this profiler started it.
+    Used as context manager, the profiler gets closed even if a stage raises.
+    '''
+    def __init__(self, timestamp=None, enabled=True, memory=True):
+        self.timestamp = timestamp
+        self.enabled = enabled
+        self.memory = memory and enabled
+        self.records = []
+        self.current = None
+        self.tracing = self.memory and not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+
+    def start(self, name):
+        if not self.enabled:
+            return
+        self.stop()
+        memory = 0
+        if self.memory:
+            tracemalloc.reset_peak()
+            memory = tracemalloc.get_traced_memory()[0]
+        self.current = (name, time.perf_counter(), time.process_time(), memory)
+
+    def stop(self):
+        if not self.enabled or self.current is None:
+            return
+        name, wall, cpu, memory = self.current
+        self.records.append({
+            'timestamp': self.timestamp,
+            'stage': name,
+            'wall': time.perf_counter() - wall,
+            'cpu': time.process_time() - cpu,
+            'peak_memory': tracemalloc.get_traced_memory()[1] - memory if self.memory else np.NaN,
+        })
+        self.current = None
+
+    def close(self):
+        '''
+        End the running stage and stop tracing memory allocations if this profiler started it
+        '''
+        self.stop()
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+            self.memory = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RunProfile:
+    '''
+    Collects the records of StageProfiler of all images of a run (e.g. output['profile']
+    of process_image) and aggregates them per stage.
+    '''
+    metrics = ['wall', 'cpu', 'peak_memory']
+
+    def __init__(self, percentiles=(50, 90, 99)):
+        self.percentiles = percentiles
+        self.records = []
+
+    def add(self, records):
+        self.records.extend(records)
+
+    def frame(self):
+        '''
+        Returns all records as DataFrame, one row per image and stage
+        '''
+        return pd.DataFrame(self.records, columns=['timestamp', 'stage'] + self.metrics)
+
+    def summary(self):
+        '''
+        Returns DataFrame with one row per stage (in order of first appearance) and
+        count, mean, percentiles and max of every metric (columns '<metric>_<statistic>')
+        '''
+        df = self.frame()
+        order = pd.unique(df.stage)
+        grouped = df.groupby('stage', sort=False)
+        columns = {'count': grouped.size()}
+        for metric in self.metrics:
+            columns['{}_mean'.format(metric)] = grouped[metric].mean()
+            for p in self.percentiles:
+                columns['{}_p{}'.format(metric, p)] = grouped[metric].quantile(p/100)
+            columns['{}_max'.format(metric)] = grouped[metric].max()
+        return pd.DataFrame(columns).reindex(order)
+
+    def write(self, filename):
+        '''
+        Write summary to filename, as CSV if filename ends with '.csv' and as JSON otherwise.
+        JSON contains the number of images and the summary per stage.
+        '''
+        summary = self.summary()
+        if filename.endswith('.csv'):
+            summary.to_csv(filename, index_label='stage')
+            return
+        report = {
+            'images': int(self.frame().timestamp.nunique()),
+            'stages': {
+                stage: dict(
+                    {key: (None if pd.isnull(value) else float(value)) for key, value in row.items()},
+                    count=int(row['count']))
+                for stage, row in summary.iterrows()
+            },
+        }
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -1,10 +1,12 @@
 from starry_night import sql
+from starry_night.store import ResultStore
+from starry_night.profiling import StageProfiler
+from starry_night import plotting
 import pandas as pd
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 from matplotlib import rc, cm
-from mpl_toolkits.axes_grid.inset_locator import inset_axes
 
 import ephem
 import sys
@@ -14,6 +16,10 @@ from astropy.io import fits
 from astropy.time import Time
 from scipy.io import matlab
 from scipy.ndimage.measurements import label
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import minimum_spanning_tree
+from scipy.spatial import cKDTree
 from io import BytesIO
 from skimage.io import imread
 from skimage.color import rgb2gray
@@ -23,12 +29,18 @@ import warnings
 from datetime import datetime, timedelta
 
 from pkg_resources import resource_filename
+import os
 from os.path import join
+from glob import glob
 import requests
 import logging
 
-from re import split
+from re import split, escape, fullmatch
 from hashlib import sha1
+from functools import lru_cache
+from collections import deque, OrderedDict
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import create_engine
 from sqlalchemy.exc import OperationalError, InternalError
 from IPython import embed
@@ -52,10 +64,12 @@ def transmission2(x, a, c):
     return a * np.exp(-c * (1/np.cos(x)*(1-0.0012*(1/np.cos(x)**2 - 1)) - 1))
 
 
-def transmission3(x, a, c):
+def airmass(x):
     '''
-    return atmospheric transmission of spheric model with elevated observer
-    This model does not return 1.0 for zenith angle so we subtract airM_0 instead in the end
+    return airmass relative to zenith of spheric model with elevated observer
+    x is the altitude in radians (not the zenith angle), the model uses the zenith angle pi/2 - x.
+    The model does not return 1.0 for zenith angle 0 so airmass at zenith is subtracted,
+    airmass(pi/2) is 0.
     '''
     yObs=2.2
     yAtm=9.5
@@ -67,7 +81,68 @@ def transmission3(x, a, c):
 
     airMass = np.sqrt( ( r + y )**2 * np.cos(x)**2 + 2.*r*(1.-y) - y**2 + 1.0 ) - (r+y)*np.cos(x)
     airM_0 = np.sqrt( ( r + y )**2 + 2.*r*(1.-y) - y**2 + 1.0 ) - (r+y)
-    return a* np.exp(-c * (airMass - airM_0 ))
+    return airMass - airM_0
+
+
+def transmission3(x, a, c):
+    '''
+    return atmospheric transmission of spheric model with elevated observer
+    '''
+    return a* np.exp(-c * airmass(x))
+
+
+def fit_transmission(hip, altitude, response, min_points=3):
+    '''
+    Fit transmission3 to the response of every star at once.
+
+    The fit is linear in log space: log(response) = log(a) - c * airmass(altitude)
+    Points get weighted with response**2, so the result is close to a least squares fit
+    of transmission3 to the response. All sums are calculated for all stars at once with np.bincount.
+
+    hip, altitude, response: arrays with one entry per star and image, altitude in radians
+    min_points: stars with less data points get NaN
+
+    Returns: DataFrame indexed by HIP with columns a, sigma_a, c, sigma_c and points
+    '''
+    hip = np.asarray(hip)
+    altitude = np.asarray(altitude, dtype=float)
+    response = np.asarray(response, dtype=float)
+    valid = (response > 0) & np.isfinite(altitude)
+    hip, x, response = hip[valid], airmass(altitude[valid]), response[valid]
+    y = np.log(response)
+    w = response**2
+
+    stars, group = np.unique(hip, return_inverse=True)
+    n = np.bincount(group, minlength=len(stars))
+    sw = np.bincount(group, w, minlength=len(stars))
+
+    # center airmass and log(response) of every star to avoid cancellation
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xMean = np.bincount(group, w*x, minlength=len(stars)) / sw
+        yMean = np.bincount(group, w*y, minlength=len(stars)) / sw
+        dx = x - xMean[group]
+        dy = y - yMean[group]
+        sxx = np.bincount(group, w*dx**2, minlength=len(stars))
+        sxy = np.bincount(group, w*dx*dy, minlength=len(stars))
+        syy = np.bincount(group, w*dy**2, minlength=len(stars))
+
+        slope = sxy / sxx
+        intercept = yMean - slope * xMean
+        # residual variance, covariance gets scaled with it like curve_fit does
+        s2 = np.clip(syy - slope * sxy, 0, None) / (n - 2)
+        sigmaSlope = np.sqrt(s2 / sxx)
+        sigmaIntercept = np.sqrt(s2 * (1 / sw + xMean**2 / sxx))
+
+    a = np.exp(intercept)
+    fit = pd.DataFrame({
+        'a': a,
+        'sigma_a': a * sigmaIntercept,
+        'c': -slope,
+        'sigma_c': sigmaSlope,
+        'points': n,
+        }, index=pd.Index(stars, name='HIP'))
+    fit.loc[(n < max(min_points, 3)) | ~(sxx > 0), ['a', 'sigma_a', 'c', 'sigma_c']] = np.NaN
+    return fit
 
 '''
 y1 = sk.transmission(x, 1, 0.57)
@@ -95,37 +170,88 @@ def get_last_modified(url, timeout):
     return date
 
 
-def downloadImg(url, timeout=None):
+class CameraState:
+    '''
+    Download state of one camera.
+
+    Remembers Last-Modified, ETag and SHA1 hashsum of the last image, so that only
+    new images get downloaded and processed.
+    '''
+    def __init__(self, url):
+        self.url = url
+        self.lastMod = None
+        self.etag = None
+        self.hash = ''
+
+    def headers(self):
+        '''
+        Returns headers for a conditional request
+        '''
+        headers = dict()
+        if self.lastMod is not None:
+            headers['If-Modified-Since'] = self.lastMod
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        return headers
+
+    def update(self, response):
+        '''
+        Returns True if response contains a new image and stores its state
+        '''
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+        lastMod = response.headers.get('Last-Modified')
+        if lastMod is not None and lastMod == self.lastMod:
+            return False
+        hashsum = sha1(response.content).hexdigest()
+        if hashsum == self.hash:
+            return False
+        self.lastMod = lastMod
+        self.etag = response.headers.get('ETag')
+        self.hash = hashsum
+        return True
+
+
+# states of cameras that are downloaded without explicit state
+downloadStates = dict()
+
+def downloadImg(url, timeout=None, state=None):
     '''
     Download image from URL and return a dict with 'img' and 'timestamp'
 
     Download will only happen, if the website was updated since the last download AND the SHA1
     hashsum differs from the previous image because sometime a website might refresh without
-    updating the image.
+    updating the image. We use conditional requests (If-Modified-Since/If-None-Match), so the
+    server only sends the image if it changed.
+    'state' is the CameraState of this url. If None, a state per url is kept in this module.
     Works with fits, mat and all common image filetypes.
     '''
     log = logging.getLogger(__name__)
-    if not hasattr(downloadImg, 'lastMod'):
-        downloadImg.lastMod = datetime(1,1,1)
-        downloadImg.hash = ''
     logging.getLogger('requests').setLevel(logging.WARNING)
+    if state is None:
+        state = downloadStates.setdefault(url, CameraState(url))
 
-    # only download if time since last image is > than wait
-    mod = get_last_modified(url, timeout=timeout)
-    if downloadImg.lastMod == mod:
+    ret = requests.get(url, headers=state.headers(), timeout=timeout)
+    if not state.update(ret):
         raise TooEarlyError()
-    else:
-        downloadImg.lastMod = mod
+    log.info('Downloaded image from {}'.format(url))
 
-    # download image data and double check if this really is a new image
-    log.info('Downloading image from {}'.format(url))
-    ret = requests.get(url, timeout=timeout)
-    if downloadImg.hash == sha1(ret.content).hexdigest():
-        raise TooEarlyError()
-    else:
-        downloadImg.hash = sha1(ret.content).hexdigest()
+    try:
+        lastMod = datetime.strptime(ret.headers['Last-Modified'], '%a, %d %b %Y %H:%M:%S GMT')
+    except (KeyError, ValueError):
+        lastMod = datetime.utcnow()
+    return decodeImg(ret.content, url, lastMod)
+
+
+def decodeImg(content, url, lastMod):
+    '''
+    Decode downloaded image data and return a dict with 'img' and 'timestamp'
+    The file type is taken from url. If the file does not contain a timestamp, 'lastMod' is used.
+    '''
     if url.split('.')[-1] == 'mat':
-        data = matlab.loadmat(BytesIO(ret.content))
+        data = matlab.loadmat(BytesIO(content))
+        timestamp = lastMod
         for d in list(data.values()):
             # loop through all keys and treat the first array with size > 100x100 as image
             # that way the name of the key does not matter
@@ -139,15 +265,15 @@ def downloadImg(url, timeout=None):
             except (IndexError, TypeError, ValueError):
                 pass
     elif url.split('.')[-1] == 'FIT':
-        hdulist = fits.open(BytesIO(ret.content), ignore_missing_end=True)
+        hdulist = fits.open(BytesIO(content), ignore_missing_end=True)
         img = hdulist[0].data+2**16/2
         timestamp = datetime.strptime(
                         hdulist[0].header['UTC'],
                         '%Y/%m/%d %H:%M:%S')
 
     else:
-        img = rgb2gray(imread(url, ))
-        timestamp = get_last_modified(url, timeout=timeout)
+        img = rgb2gray(imread(BytesIO(content)))
+        timestamp = lastMod
         
     return {
         'img' : img,
@@ -163,43 +289,101 @@ def getBlobsize(img, thresh, limit=0):
 
     A blob consists of all 8 neighboors that are bigger than 'thresh' and their neighboors respectively.
     '''
-    if thresh <= 0:
+    return getBlobsizes(img[np.newaxis], thresh, limit)[0]
+
+
+def getBlobsizes(windows, thresh, limit=0):
+    '''
+    Vectorized version of getBlobsize for a stack of windows with shape (n, rows, cols),
+    e.g. the cutouts returned by getLocalWindows.
+    'thresh' can be a scalar or one threshold per window.
+    Returns the blob size of every window, sizes bigger than limit are returned as limit.
+
+    All windows get labeled at once, so there are no loops over stars or pixels.
+    '''
+    windows = np.asarray(windows)
+    n, rows, cols = windows.shape
+    thresh = np.broadcast_to(np.asarray(thresh, dtype=float), (n,))
+    if not np.all(thresh > 0):
         raise ValueError('Thresh > 0 required')
-    if img.shape[0]%2 == 0 or img.shape[1]%2==0:
-        raise IndexError('Only odd sized arrays are supported. Array shape:{}'.format(img.shape))
+    if rows%2 == 0 or cols%2==0:
+        raise IndexError('Only odd sized arrays are supported. Array shape:{}'.format(windows.shape[1:]))
     if limit == 0:
-        limit = img.shape[0]*img.shape[1]
+        limit = rows*cols
+    if n == 0:
+        return np.zeros(0, dtype=int)
+
+    # NaN is never above threshold
+    with np.errstate(invalid='ignore'):
+        above = windows >= thresh[:, np.newaxis, np.newaxis]
+
+    # connect 8 neighboors within a window, but never pixels of different windows
+    structure = np.zeros((3,3,3), dtype=bool)
+    structure[1] = True
+    labels, _ = label(above, structure=structure)
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+
+    # the blob of a window are all pixels connected to the 3x3 pixels around the center.
+    # Those might belong to different labels, count every label only once
+    cy, cx = rows//2, cols//2
+    center = labels[:, max(cy-1, 0):cy+2, max(cx-1, 0):cx+2].reshape(n, -1)
+    center = np.sort(center, axis=1)
+    unique = np.ones(center.shape, dtype=bool)
+    unique[:, 1:] = center[:, 1:] != center[:, :-1]
+    count = np.where(unique, sizes[center], 0).sum(axis=1)
+
+    return np.minimum(count, limit)
+
+
+def filterBank(img, sigmas, function='LoG'):
+    '''
+    Returns the response of 'function' ('LoG' or 'DoG') for every sigma in sigmas
+    as one array of shape (len(sigmas), rows, cols).
 
-    center = (img.shape[0]//2, img.shape[1]//2)
+    The gaussian scale-space is calculated incrementally: every level is derived from the
+    previous one by filtering with sqrt(sigma_k**2 - sigma_(k-1)**2), which is much cheaper
+    than filtering img again with a big sigma. Levels are dropped as soon as they are not needed anymore.
+    '''
+    sigmas = np.atleast_1d(sigmas).astype(float)
+    if function == 'LoG':
+        needs = [(sigma,) for sigma in sigmas]
+    elif function == 'DoG':
+        needs = [(sigma, 1.6*sigma) for sigma in sigmas]
+    else:
+        raise ValueError('Function {} is not supported by filterBank'.format(function))
+
+    # NaNs would spread further with every level, so filter without them and
+    # restore the NaN area a direct gaussian filter would have (radius = 4 sigma)
+    invalid = np.isnan(img)
+    def spread(sigma):
+        return ndimage.maximum_filter(invalid, size=2*int(4*sigma+0.5)+1)
+
+    cube = np.empty((len(sigmas),) + img.shape, dtype=img.dtype)
+    gauss = dict()
+    level = np.where(invalid, 0, img)
+    last = 0
+    for sigma in np.unique(np.concatenate(needs)):
+        # same as skimage.filters.gaussian, but keeps the dtype of img (e.g. float32)
+        level = ndimage.gaussian_filter(level, sigma=np.sqrt(sigma**2 - last**2), mode='nearest')
+        last = sigma
+        gauss[sigma] = level
+
+        for i, need in enumerate(needs):
+            if need is not None and max(need) == sigma:
+                if function == 'LoG':
+                    cube[i] = skimage.filters.laplace(gauss[need[0]], ksize=3).clip(min=0)
+                    if invalid.any():
+                        cube[i][ndimage.binary_dilation(spread(need[0]))] = np.NaN
+                else:
+                    cube[i] = gauss[need[0]] - gauss[need[1]]
+                    if invalid.any():
+                        cube[i][spread(need[1])] = np.NaN
+                needs[i] = None
+        pending = {s for need in needs if need is not None for s in need}
+        gauss = {s: g for s, g in gauss.items() if s in pending or s == sigma}
+    return cube
 
-    # if all pixels are above threshold then return max blob size
-    if thresh <= np.min(img):
-        return np.minimum(limit, img.shape[0]*img.shape[1])
-    
-    # work on local copy
-    tempImg = img.copy()
-    tempImg[~np.isfinite(tempImg)] = 0
-
-    nList = list()
-    count = 0
-
-    # fill list with pixels and count them
-    nList.append(center)
-    while len(nList) > 0:
-        x,y = nList.pop(0)
-
-        for i in (-1,0,1):
-            for j in (-1,0,1):
-                if x+i<0 or x+i>=img.shape[0] or y+j<0 or y+j>=img.shape[1]:
-                    pass
-                elif tempImg[x+i,y+j] >= thresh:
-                    count += 1
-                    tempImg[x+i,y+j] = 0
-                    nList.append((x+i,y+j))
-        if count >= limit:
-            return limit
-    return count
-    
 
 def run():
     log = logging.getLogger(__name__)
@@ -313,11 +497,23 @@ def find_matching_pos(img_timestamp, time_pos_list):
 
     Since the lidar operates all the time but we only take images every few minutes 
     we need to find out where the lidar was looking at that point in time when we took the image
+
+    time_pos_list must be sorted by MJD, e.g. the structured array of load_positioning
+    or a sorted DataFrame. Lookup is a binary search.
     '''
+    mjd = np.asarray(time_pos_list['MJD'])
+
     # select measurements that were taken not later than 5 minutes before the image
-    subset = time_pos_list.query('1/24/60 * 5 < MJD - {} < 1/24/60*10'.format(img_timestamp)).sort_values('MJD')
-    closest = subset[subset.MJD==subset.MJD.min()]
-    return closest[['ra','dec']]
+    first = np.searchsorted(mjd, img_timestamp + 1/24/60 * 5, side='right')
+    last = np.searchsorted(mjd, img_timestamp + 1/24/60 * 10, side='left')
+    if first >= last:
+        last = first
+    else:
+        last = min(last, np.searchsorted(mjd, mjd[first], side='right'))
+    return pd.DataFrame({
+        'ra': np.asarray(time_pos_list['ra'])[first:last],
+        'dec': np.asarray(time_pos_list['dec'])[first:last],
+    })
 
 
 
@@ -368,52 +564,236 @@ def equatorial2horizontal(ra, dec, observer):
     return az, alt
 
 
-def celObjects_dict(config):
+class SkyGeometry:
     '''
-    Read the given star catalog, add planets from ephem and fill sun and moon with NaNs
-    For horizontal coordinates 'update_star_position()' needs to be called next.
+    Projection of the star catalogue into the image of one camera.
 
-    Returns: dictionary with celestial objects
+    Camera constants, the vmag cut and everything that does not change with time
+    (sin/cos of declination and site latitude) get calculated once. For a fixed site only the
+    sidereal time changes between two images, so positions_at() is just a few vector operations.
+    '''
+    def __init__(self, stars, conf, observer):
+        cam = conf['image']
+        self.zenith_x = float(cam['zenith_x'])
+        self.zenith_y = float(cam['zenith_y'])
+        self.radius = float(cam['radius'])
+        self.azimuthoffset = np.deg2rad(float(cam['azimuthoffset']))
+        self.angleprojection = cam['angleprojection']
+        self.resolution = tuple(map(int, split('\\s*,\\s*', cam['resolution'])))
+        self.min_altitude = np.deg2rad(90 - float(cam['openingangle']))
+
+        obs_lat = float(observer.lat)
+        self.sin_lat = np.sin(obs_lat)
+        self.cos_lat = np.cos(obs_lat)
+
+        # stars fainter than vmaglimit never get analysed, so we don't need to project them
+        self.rows = np.flatnonzero((stars.vmag < float(conf['analysis']['vmaglimit'])).values)
+        self.ra = np.ascontiguousarray(stars.ra.values[self.rows], dtype=float)
+        self.vmag = np.ascontiguousarray(stars.vmag.values[self.rows], dtype=float)
+        self.hip = stars.index.values[self.rows]
+        dec = np.ascontiguousarray(stars.dec.values[self.rows], dtype=float)
+        self.sin_dec = np.sin(dec)
+        self.cos_dec = np.cos(dec)
+        self.tan_dec = np.tan(dec)
+
+    def equatorial2horizontal(self, ra, sin_dec, cos_dec, tan_dec, sidereal_time):
+        '''
+        Same as equatorial2horizontal() but with precalculated sin/cos/tan of declination
+        '''
+        h = sidereal_time - ra
+        cos_h = np.cos(h)
+        alt = np.arcsin(self.sin_lat * sin_dec + self.cos_lat * cos_dec * cos_h)
+        az = np.arctan2(np.sin(h), cos_h * self.sin_lat - tan_dec * self.cos_lat)
+
+        # correction for camera orientation
+        az = np.mod(az+np.pi, 2*np.pi)
+        return az, alt
+
+    def horizontal2image(self, az, alt):
+        '''
+        Same as horizontal2image() but with the parsed camera constants
+        '''
+        r = theta2r(np.pi/2 - alt, self.radius, how=self.angleprojection)
+        x = self.zenith_x + r * np.cos(az + self.azimuthoffset)
+        y = self.zenith_y - r * np.sin(az + self.azimuthoffset)
+        return x, y
+
+    def project(self, ra, dec, sidereal_time):
+        '''
+        Returns azimuth, altitude, x and y for arbitrary objects (e.g. points of interest)
+        '''
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)
+        az, alt = self.equatorial2horizontal(ra, np.sin(dec), np.cos(dec), np.tan(dec), sidereal_time)
+        x, y = self.horizontal2image(az, alt)
+        return az, alt, x, y
+
+    def positions_at(self, sidereal_time):
+        '''
+        Returns azimuth, altitude, x and y of all catalogue stars brighter than vmaglimit
+        (catalogue rows self.rows) as contiguous arrays
+        '''
+        az, alt = self.equatorial2horizontal(self.ra, self.sin_dec, self.cos_dec, self.tan_dec, float(sidereal_time))
+        x, y = self.horizontal2image(az, alt)
+        return az, alt, x, y
+
+
+cache_directory = join(os.path.expanduser('~'), '.starry_night', 'cache')
+
+def load_cached(filename, key, build, cache_dir=cache_directory, stale=None):
+    '''
+    Returns the structured array that build(filename) creates as memory mapped array.
+
+    The array is created on first use and stored in cache_dir. The name of the cache file contains
+    'key', so it gets created again if key changes (e.g. because the file changed).
+    Every process that loads the same file shares its memory.
+    'stale' is a regular expression that matches the keys of older versions of the file,
+    their caches get removed. Caches of other keys are kept.
     '''
     log = logging.getLogger(__name__)
-    
-    log.debug('Loading stars')
-    catalogue = resource_filename('starry_night', 'data/catalogue_10vmag_1degFilter.csv')
+    name = os.path.splitext(os.path.basename(filename))[0]
+    cache = join(cache_dir, '{}-{}.npy'.format(name, key))
+
+    try:
+        return np.load(cache, mmap_mode='r')
+    except (OSError, ValueError):
+        log.debug('No valid cache for {}'.format(filename))
+
+    array = build(filename)
+
+    # write to a temporary file first, so parallel processes never read half written files
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = '{}.{}.tmp'.format(cache, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp, cache)
+    except OSError as e:
+        log.warning('Unable to cache {} in {}: {}'.format(filename, cache_dir, e))
+        return array
+    log.info('Cached {} in {}'.format(filename, cache))
+
+    # remove caches of older versions of the file, other processes might remove them at the same time
+    if stale is not None:
+        for old in os.listdir(cache_dir):
+            if old != os.path.basename(cache) and fullmatch('{}-{}\\.npy'.format(escape(name), stale), old):
+                try:
+                    os.remove(join(cache_dir, old))
+                except OSError as e:
+                    log.debug('Unable to remove old cache {}: {}'.format(old, e))
     try:
+        return np.load(cache, mmap_mode='r')
+    except (OSError, ValueError):
+        # a newer version of the file was cached by another process in the meantime
+        return array
+
+
+catalogue_dtype = np.dtype([
+    ('HIP', np.int64), ('gLon', float), ('gLat', float), ('ra', float), ('dec', float), ('vmag', float),
+    ('ux', float), ('uy', float), ('uz', float),
+])
+
+def load_catalogue(filename, cache_dir=cache_directory):
+    '''
+    Returns the star catalogue in 'filename' (csv, ra and dec in degree) as memory mapped
+    structured array with ra and dec in radians and the unit vectors ux, uy, uz of every star.
+    The cache gets invalidated by the SHA1 of the csv file, see load_cached().
+    '''
+    def build(filename):
         stars = pd.read_csv(
-            catalogue,
+            filename,
             sep=',',
             comment='#',
             header=0,
             skipinitialspace=False,
-            index_col=0,
         )
+        catalogue = np.empty(len(stars.index), dtype=catalogue_dtype)
+        catalogue['HIP'] = stars.HIP.values
+        catalogue['gLon'] = stars.gLon.values
+        catalogue['gLat'] = stars.gLat.values
+        catalogue['ra'] = np.deg2rad(stars.ra.values)
+        catalogue['dec'] = np.deg2rad(stars.dec.values)
+        catalogue['vmag'] = stars.vmag.values
+        catalogue['ux'], catalogue['uy'], catalogue['uz'] = unitVectors(catalogue['ra'], catalogue['dec']).T
+        return catalogue
+
+    with open(filename, 'rb') as f:
+        hashsum = sha1(f.read()).hexdigest()
+    return load_cached(filename, hashsum, build, cache_dir, stale='[0-9a-f]{40}')
+
+
+positioning_dtype = np.dtype([('MJD', float), ('ra', float), ('dec', float)])
+
+def load_positioning(filename, start=None, end=None, cache_dir=cache_directory):
+    '''
+    Returns MJD, ra and dec (degree) of the positioning file (HDF5, key 'table')
+    sorted by MJD as memory mapped structured array.
+
+    If start and end (datetime) of the images are known, only the positions that
+    find_matching_pos can return for these images are kept. Files in table format are
+    read in chunks, so the whole file never has to fit into memory.
+    Positioning files are huge, so the cache gets invalidated by size and modification time, see load_cached().
+    '''
+    lo = -np.inf if start is None else Time(start).mjd
+    hi = np.inf if end is None else Time(end).mjd + 1/24/60*10
+
+    def build(filename):
+        try:
+            chunks = pd.read_hdf(filename, key='table', columns=['MJD','ra','dec'], chunksize=10**6)
+        except TypeError:
+            # fixed format does not support chunks
+            chunks = [pd.read_hdf(filename, key='table')[['MJD','ra','dec']]]
+        table = pd.concat([chunk[(chunk.MJD.values >= lo) & (chunk.MJD.values <= hi)] for chunk in chunks])
+        table = table.sort_values('MJD', kind='mergesort')
+        positioning = np.empty(len(table.index), dtype=positioning_dtype)
+        for key in positioning_dtype.names:
+            positioning[key] = table[key].values
+        return positioning
+
+    stat = os.stat(filename)
+    key = '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+    span = ''
+    if start is not None or end is not None:
+        span = '-{:.6f}-{:.6f}'.format(lo, hi)
+    # only older versions of the same time span are stale
+    return load_cached(filename, key + span, build, cache_dir, stale='[0-9]+-[0-9]+' + escape(span))
+
+
+def celObjects_dict(config):
+    '''
+    Read the given star catalog, add planets from ephem and fill sun and moon with NaNs
+    For horizontal coordinates 'update_star_position()' needs to be called next.
+
+    Returns: dictionary with celestial objects
+    '''
+    log = logging.getLogger(__name__)
+    
+    log.debug('Loading stars')
+    try:
+        catalogue = load_catalogue(resource_filename('starry_night', 'data/catalogue_10vmag_1degFilter.csv'))
     except OSError as e:
         log.error('Star catalogue not found: {}'.format(e))
         sys.exit(1)
-    #stars = stars.to_numeric()
-
-    # transform degrees to radians
-    stars.ra = np.deg2rad(stars.ra)
-    stars.dec = np.deg2rad(stars.dec)
 
+    # ra and dec are in radians already
+    stars = pd.DataFrame(
+        {key: catalogue[key] for key in ['gLon', 'gLat', 'ra', 'dec', 'vmag']},
+        index=pd.Index(catalogue['HIP'], name='HIP'),
+    )
     stars['altitude'] = np.NaN
     stars['azimuth'] = np.NaN
 
     # add the planets
-    planets = pd.DataFrame()
-    for planet in ['Mercury', 'Venus', 'Mars', 'Jupiter', 'Saturn', 'Uranus', 'Neptune']:
-        data = {
-            'ra': np.NaN,
-            'dec': np.NaN,
-            'altitude' : np.NaN,
-            'azimuth' : np.NaN,
-            'gLon': np.NaN,
-            'gLat': np.NaN,
-            'vmag': np.NaN,
-            'name': planet,
-        }
-        planets = planets.append(data, ignore_index=True)
+    planets = pd.DataFrame({
+        'ra': np.NaN,
+        'dec': np.NaN,
+        'altitude' : np.NaN,
+        'azimuth' : np.NaN,
+        'gLon': np.NaN,
+        'gLat': np.NaN,
+        'vmag': np.NaN,
+        'name': ['Mercury', 'Venus', 'Mars', 'Jupiter', 'Saturn', 'Uranus', 'Neptune'],
+    })
 
     # add points_of_interest
     log.debug('Add points of interest')
@@ -467,6 +847,7 @@ def celObjects_dict(config):
         'points_of_interest' : points_of_interest,
         'sun': sunData,
         'moon': moonData,
+        'geometry': SkyGeometry(stars, config, obs_setup(config['properties'])),
         })
 
 
@@ -529,12 +910,16 @@ def update_star_position(data, observer, conf, crop, args):
         planets = planets.append(p, ignore_index=True)
     planets.set_index('name', inplace=True)
 
-    # make a copy here, because we will need ALL stars later again
+    # the geometry only has to be set up once per camera
+    if 'geometry' not in data:
+        data['geometry'] = SkyGeometry(data['stars'], conf, observer)
+    geometry = data['geometry']
+    sidereal_time = float(observer.sidereal_time())
+
     # append lidar position from positioning file if any
     # append Total_sky object 
     # update all objects
     # remove objects that are not within the limits
-    stars = data['stars'].copy()
     points_of_interest = data['points_of_interest'].copy()
     if args['-p']:
         lidar = find_matching_pos(Time(data['timestamp']).mjd, data['positioning_file'])/180*np.pi
@@ -543,11 +928,8 @@ def update_star_position(data, observer, conf, crop, args):
         lidar['radius'] = float(conf['analysis']['poi_radius'])
         points_of_interest = points_of_interest.append(lidar, ignore_index=True)
 
-    stars['azimuth'], stars['altitude'] = equatorial2horizontal(
-        stars.ra, stars.dec, observer,
-    )
-    points_of_interest['azimuth'], points_of_interest['altitude'] = equatorial2horizontal(
-        points_of_interest.ra, points_of_interest.dec, observer,
+    points_of_interest['azimuth'], points_of_interest['altitude'], points_of_interest['x'], points_of_interest['y'] = geometry.project(
+        points_of_interest.ra.values, points_of_interest.dec.values, sidereal_time,
     )
     points_of_interest.append({
         'name': 'Total_sky',
@@ -558,18 +940,16 @@ def update_star_position(data, observer, conf, crop, args):
     }, ignore_index=True)
 
     try:
-        stars.query('altitude > {} & vmag < {}'.format(np.deg2rad(90 - float(conf['image']['openingangle'])), conf['analysis']['vmaglimit']), inplace=True)
-        planets.query('altitude > {} & vmag < {}'.format(np.deg2rad(90 - float(conf['image']['openingangle'])), conf['analysis']['vmaglimit']), inplace=True)
-        points_of_interest.query('altitude > {}'.format(np.deg2rad(90 - float(conf['image']['openingangle']))), inplace=True)
+        planets.query('altitude > {} & vmag < {}'.format(geometry.min_altitude, conf['analysis']['vmaglimit']), inplace=True)
+        points_of_interest.query('altitude > {}'.format(geometry.min_altitude), inplace=True)
     except:
         log.error('Using altitude or vmag limit failed!')
         raise
 
-    # calculate angle to moon
-    log.debug('Calculate Angle to Moon')
-    stars['angleToMoon'] = np.arccos(np.sin(stars.altitude.values)*
-        np.sin(moon.alt) + np.cos(stars.altitude.values)*np.cos(moon.alt)*
-        np.cos((stars.azimuth.values - moon.az)))
+    # calculate position of all stars and angle to moon
+    log.debug('Calculate star positions and angle to Moon')
+    az, alt, x, y = geometry.positions_at(sidereal_time)
+    angleToMoon = np.arccos(np.sin(alt)*np.sin(moon.alt) + np.cos(alt)*np.cos(moon.alt)*np.cos(az - moon.az))
     planets['angleToMoon'] = np.arccos(np.sin(planets.altitude.values)*
         np.sin(moon.alt) + np.cos(planets.altitude.values)*np.cos(moon.alt)*
         np.cos((planets.azimuth.values - moon.az)))
@@ -577,27 +957,32 @@ def update_star_position(data, observer, conf, crop, args):
         np.sin(moon.alt) + np.cos(points_of_interest.altitude.values)*np.cos(moon.alt)*
         np.cos((points_of_interest.azimuth.values - moon.az)))
 
-    # remove stars and planets that are too close to moon
-    stars.query('angleToMoon > {}'.format(np.deg2rad(float(conf['analysis']['minAngleToMoon']))), inplace=True)
-    planets.query('angleToMoon > {}'.format(np.deg2rad(float(conf['analysis']['minAngleToMoon']))), inplace=True)
-
+    # remove stars that are below the altitude limit, too close to moon or outside of the image
+    # and make a copy of the remaining ones, because we will need ALL stars later again
+    minAngleToMoon = np.deg2rad(float(conf['analysis']['minAngleToMoon']))
+    res = geometry.resolution
+    keep = ((alt > geometry.min_altitude) & (angleToMoon > minAngleToMoon) &
+            (0 < x) & (x < res[0]) & (0 < y) & (y < res[1]))
+    stars = data['stars'].iloc[geometry.rows[keep]].copy()
+    stars['azimuth'] = az[keep]
+    stars['altitude'] = alt[keep]
+    stars['angleToMoon'] = angleToMoon[keep]
+    stars['x'] = x[keep]
+    stars['y'] = y[keep]
+    planets.query('angleToMoon > {}'.format(minAngleToMoon), inplace=True)
 
     # calculate x and y position
     log.debug('Calculate x and y')
-    stars['x'], stars['y'] = horizontal2image(stars.azimuth, stars.altitude, cam=conf['image'])
-    planets['x'], planets['y'] = horizontal2image(planets.azimuth, planets.altitude, cam=conf['image'])
-    points_of_interest['x'], points_of_interest['y'] = horizontal2image(points_of_interest.azimuth, points_of_interest.altitude, cam=conf['image'])
-    moonData['x'], moonData['y'] = horizontal2image(moonData['azimuth'], moonData['altitude'], cam=conf['image'])
-    sunData['x'], sunData['y'] = horizontal2image(sunData['azimuth'], sunData['altitude'], cam=conf['image'])
+    planets['x'], planets['y'] = geometry.horizontal2image(planets.azimuth.values, planets.altitude.values)
+    moonData['x'], moonData['y'] = geometry.horizontal2image(moonData['azimuth'], moonData['altitude'])
+    sunData['x'], sunData['y'] = geometry.horizontal2image(sunData['azimuth'], sunData['altitude'])
 
     # remove stars and planets that are withing cropping area
-    res = list(map(int, split('\\s*,\\s*', conf['image']['resolution'])))
-    stars.query('0 < x < {} & 0 < y < {}'.format(res[0] ,res[1]), inplace=True)
     planets.query('0 < x < {} & 0 < y < {}'.format(res[0] ,res[1]), inplace=True)
     points_of_interest.query('0 < x < {} & 0 < y < {}'.format(res[0] ,res[1]), inplace=True)
-    stars = stars[stars.apply(lambda s, crop=crop: ~crop[int(s['y']), int(s['x'])], axis=1)]
-    planets = planets[planets.apply(lambda p, crop=crop: ~crop[int(p['y']), int(p['x'])], axis=1)]
-    points_of_interest = points_of_interest[points_of_interest.apply(lambda s, crop=crop: ~crop[int(s['y']), int(s['x'])], axis=1)]
+    stars = stars[~isCropped(crop, stars.x.values, stars.y.values)]
+    planets = planets[~isCropped(crop, planets.x.values, planets.y.values)]
+    points_of_interest = points_of_interest[~isCropped(crop, points_of_interest.x.values, points_of_interest.y.values)]
 
     return {'stars':stars, 'planets':planets, 'points_of_interest': points_of_interest, 'moon': moonData, 'sun': sunData}
 
@@ -657,32 +1042,80 @@ def findLocalMean(img, x, y, radius):
         return 0
 
 
+def getLocalWindows(img, x, y, radius, fill=np.NaN):
+    '''
+    Returns the (2*radius+1)x(2*radius+1) neighbourhood of every position (x,y) in one array
+    of shape (len(x), 2*radius+1, 2*radius+1) and a boolean array of the same shape that
+    marks pixels that lie inside of img. Pixels outside of img are set to 'fill'.
+
+    If img has more than 2 dimensions, the last two are treated as y and x and all leading
+    dimensions are kept, e.g. a stack of images of shape (k, rows, cols) returns windows
+    of shape (k, len(x), 2*radius+1, 2*radius+1).
+    '''
+    x = np.atleast_1d(x).astype(int)
+    y = np.atleast_1d(y).astype(int)
+    offset = np.arange(-radius, radius+1)
+    rows = y[:, np.newaxis] + offset
+    cols = x[:, np.newaxis] + offset
+    valid = (((rows >= 0) & (rows < img.shape[-2]))[:, :, np.newaxis] &
+            ((cols >= 0) & (cols < img.shape[-1]))[:, np.newaxis, :])
+    windows = img[...,
+            np.clip(rows, 0, img.shape[-2]-1)[:, :, np.newaxis],
+            np.clip(cols, 0, img.shape[-1]-1)[:, np.newaxis, :]]
+    return np.where(valid, windows, fill), valid
+
+
+def findLocalMax(img, x, y, radius):
+    '''
+    Vectorized version of findLocalMaxPos and findLocalMaxValue for many positions at once.
+
+    Returns: -maxX, maxY: position of brightest pixel within radius around every (x,y).
+              If all pixels have equal brightness, (x,y) is returned and if all pixels are NaN (0,0)
+             -maxValue: value of brightest pixel within radius (NaN if all pixels are NaN,
+              0 if the window lies completely outside of img)
+
+    If img is a stack of images (e.g. the response cube of filterBank), all images get searched
+    at once and every result has shape (len(img), len(x)).
+    '''
+    x = np.atleast_1d(x).astype(int)
+    y = np.atleast_1d(y).astype(int)
+    lead = img.shape[:-2]
+    maxX = np.array(np.broadcast_to(x, lead + x.shape))
+    maxY = np.array(np.broadcast_to(y, lead + y.shape))
+    maxValue = np.zeros(lead + x.shape)
+    size = 2*radius+1
+
+    # windows that lie completely outside of img have no max
+    inside = np.flatnonzero((x+radius >= 0) & (x-radius < img.shape[-1]) & (y+radius >= 0) & (y-radius < img.shape[-2]))
+
+    # process stars in chunks, big radii would need too much memory otherwise
+    step = max(1, 2**22 // (size**2 * int(np.prod(lead))))
+    for start in range(0, len(inside), step):
+        i = inside[start:start+step]
+        windows, valid = getLocalWindows(img, x[i], y[i], radius)
+        windows = windows.reshape(lead + (len(i), -1))
+        valid = valid.reshape(len(i), -1)
+        isnan = np.isnan(windows)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            vmax = np.nanmax(windows, axis=-1)
+            vmin = np.nanmin(windows, axis=-1)
+
+        # same as 'np.max(subImg) != np.min(subImg)' in findLocalMaxPos, NaNs inside img count
+        search = np.any(isnan & valid, axis=-1) | (vmax != vmin)
+        maxPos = np.argmax(np.where(isnan, -np.inf, windows), axis=-1)
+        maxX[..., i] = np.where(np.isnan(vmax), 0, np.where(search, x[i] + maxPos % size - radius, x[i]))
+        maxY[..., i] = np.where(np.isnan(vmax), 0, np.where(search, y[i] + maxPos // size - radius, y[i]))
+        maxValue[..., i] = vmax
+    return maxX, maxY, maxValue
+
+
 def findLocalMaxValue(img, x, y, radius):
     '''
     ' Returns value of brightest pixel within radius
     '''
-    try:
-        x = int(x)
-        y = int(y)
-    except TypeError:
-        x = x.astype(int)
-        y = y.astype(int)
-    
-    # get interval border
-    x_interval = np.max([x-radius,0]) , np.min([x+radius+1, img.shape[1]])
-    y_interval = np.max([y-radius,0]) , np.min([y+radius+1, img.shape[0]])
-    radius = x_interval[1]-x_interval[0] , y_interval[1]-y_interval[0]
-
-    # do subselection
-    subImg = img[y_interval[0]:y_interval[1] , x_interval[0]:x_interval[1]]
-    try:
-        return np.nanmax(subImg.flatten())
-    except RuntimeWarning:
-        print('NAN')
-        return 0
-    except ValueError:
-        print('Star outside image')
-        return 0
+    return findLocalMax(img, x, y, radius)[2][0]
 
 
 def findLocalMaxPos(img, x, y, radius):
@@ -690,28 +1123,26 @@ def findLocalMaxPos(img, x, y, radius):
     ' Returns x and y position of brightest pixel within radius
     ' If all pixel have equal brightness, current position is returned
     '''
-    try:
-        x = int(x)
-        y = int(y)
-    except TypeError:
-        x = x.astype(int)
-        y = y.astype(int)
-    # get interval border
-    x_interval = np.max([x-radius,0]) , np.min([x+radius+1, img.shape[1]])
-    y_interval = np.max([y-radius,0]) , np.min([y+radius+1, img.shape[0]])
-    radius = x_interval[1]-x_interval[0] , y_interval[1]-y_interval[0]
-    subImg = img[y_interval[0]:y_interval[1] , x_interval[0]:x_interval[1]]
-    if np.max(subImg) != np.min(subImg):
-        try:
-            maxPos = np.nanargmax(subImg)
-            x = (maxPos%radius[0])+x_interval[0]
-            y = (maxPos//radius[0])+y_interval[0]
-        except ValueError:
-            return pd.Series({'maxX':0, 'maxY':0})
-    return pd.Series({'maxX':int(x), 'maxY':int(y)})
+    maxX, maxY, _ = findLocalMax(img, x, y, radius)
+    return pd.Series({'maxX':int(maxX[0]), 'maxY':int(maxY[0])})
+
+
+def parse_timestamps(filepaths, config, fmt=None):
+    '''
+    Parse the timestamps of many image files from their names at once, see getImageDict.
+
+    Returns: DatetimeIndex with NaT for files whose time is not part of the
+             name (mat and fits files) or whose name does not match the format
+    '''
+    fmt = config['properties']['timeformat'] if fmt is None else fmt
+    filepaths = list(filepaths)
+    names = pd.Series([f.split('/')[-1].split('.')[0] for f in filepaths], dtype=object)
+    timestamps = pd.to_datetime(names, format=fmt, errors='coerce')
+    timestamps[[f.split('.')[-1] in ('mat', 'fits', 'gz') for f in filepaths]] = pd.NaT
+    return pd.DatetimeIndex(timestamps + timedelta(minutes=float(config['properties']['timeoffset'])))
 
 
-def getImageDict(filepath, config, crop=None, fmt=None):
+def getImageDict(filepath, config, crop=None, fmt=None, timestamp=None, memmap=False):
     '''
     Open an image file and return its content as a numpy array.
     
@@ -720,6 +1151,10 @@ def getImageDict(filepath, config, crop=None, fmt=None):
         crop: crop image to a circle with center and radius
         fmt: format timestring like 'gtc_allskyimage_%Y%m%d_%H%M%S.jpg'
             used for parsing the date from filename
+        timestamp: time of the image including time offset (see parse_timestamps),
+            if given the filename does not get parsed. Ignored for mat and fits files.
+        memmap: open fits files memory mapped, the data is read when it is used
+            (not possible for scaled data, e.g. with BZERO)
     Returns: Dictionary with image array and timestamp datetime object
     '''
     log = logging.getLogger(__name__)
@@ -738,7 +1173,8 @@ def getImageDict(filepath, config, crop=None, fmt=None):
 
     # read fits file
     elif (filetype == 'fits') or (filetype == 'gz'):
-        hdulist = fits.open(filepath, ignore_missing_end=True)
+        # without memmap astropy decides itself (None), like before memmap was an option
+        hdulist = fits.open(filepath, ignore_missing_end=True, memmap=True if memmap else None)
         img = hdulist[0].data
         time = datetime.strptime(
             hdulist[0].header['TIMEUTC'],
@@ -751,6 +1187,8 @@ def getImageDict(filepath, config, crop=None, fmt=None):
         except (FileNotFoundError, OSError, ValueError) as e:
             log.error('Error reading file \'{}\': {}'.format(filename+'.'+filetype, e))
             return
+        if timestamp is not None:
+            return dict({'img': img, 'timestamp': timestamp})
         try:
             if fmt is None:
                 time = datetime.strptime(filename, config['properties']['timeformat'])
@@ -766,6 +1204,37 @@ def getImageDict(filepath, config, crop=None, fmt=None):
     time += timedelta(minutes=float(config['properties']['timeoffset']))
     return dict({'img': img, 'timestamp': time})
 
+def read_images(filepaths, config, threads=4, prefetch=16, fmt=None, memmap=False):
+    '''
+    Yield the image dictionaries (see getImageDict) of all files in filepaths in order.
+
+    Images get decoded in 'threads' threads ahead of the consumer (decoders release the GIL),
+    so reading overlaps with the analysis. At most 'prefetch' images are decoded ahead, so memory
+    stays bounded. filepaths can be a lazy iterator, e.g. of a directory walk, and timestamps
+    of the next files get parsed from their names in bulk. Files that can not be read are skipped.
+    '''
+    log = logging.getLogger(__name__)
+    filepaths = iter(filepaths)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            if len(pending) <= prefetch//2:
+                batch = list(islice(filepaths, prefetch - len(pending)))
+                for filepath, timestamp in zip(batch, parse_timestamps(batch, config, fmt)):
+                    timestamp = None if pd.isnull(timestamp) else timestamp.to_pydatetime()
+                    pending.append((filepath, executor.submit(getImageDict, filepath, config, fmt=fmt, timestamp=timestamp, memmap=memmap)))
+            if not pending:
+                return
+            filepath, future = pending.popleft()
+            try:
+                image = future.result()
+            except Exception as e:
+                log.error('Unable to read image {}: {}'.format(filepath, e))
+                continue
+            if image:
+                yield image
+
+
 def update_crop_moon(crop_mask, moon, conf):
     nrows, ncols = crop_mask.shape
     row, col = np.ogrid[:nrows, :ncols]
@@ -781,16 +1250,30 @@ def get_crop_mask(img, crop):
     '''
     crop is dictionary with cropping information
     returns a boolean array in size of img: False got cropped; True not cropped 
+
+    The mask only depends on the image size and the crop config, so it gets calculated
+    once per process and is returned as read only array.
     '''
-    nrows, ncols = img.shape
+    return _crop_mask(
+            img.shape,
+            crop['crop_x'],
+            crop['crop_y'],
+            crop['crop_radius'],
+            crop['crop_deleteinside'],
+            )
+
+
+@lru_cache(maxsize=8)
+def _crop_mask(shape, crop_x, crop_y, crop_radius, crop_deleteinside):
+    nrows, ncols = shape
     row, col = np.ogrid[:nrows, :ncols]
     disk_mask = np.full((nrows, ncols), False, dtype=bool)
 
     try:
-        x = list(map(int, split('\\s*,\\s*', crop['crop_x'])))
-        y = list(map(int, split('\\s*,\\s*', crop['crop_y'])))
-        r = list(map(int, split('\\s*,\\s*', crop['crop_radius'])))
-        inside = list(map(int, split('\\s*,\\s*', crop['crop_deleteinside'])))
+        x = list(map(int, split('\\s*,\\s*', crop_x)))
+        y = list(map(int, split('\\s*,\\s*', crop_y)))
+        r = list(map(int, split('\\s*,\\s*', crop_radius)))
+        inside = list(map(int, split('\\s*,\\s*', crop_deleteinside)))
         for x,y,r,inside in zip(x,y,r,inside):
             if inside == 0:
                 disk_mask = disk_mask | ((row - y)**2 + (col - x)**2 > r**2)
@@ -801,9 +1284,17 @@ def get_crop_mask(img, crop):
         log.error('Cropping failed, maybe there is a typing error in the config file?')
         disk_mask = np.full((nrows, ncols), False, dtype=bool)
 
+    disk_mask.flags.writeable = False
     return disk_mask
 
 
+def isCropped(crop, x, y):
+    '''
+    Returns True for every position (x,y) that lies within the cropped area of crop
+    '''
+    return crop[np.asarray(y).astype(int), np.asarray(x).astype(int)]
+
+
 def loadImageTime(filename):
     # assuming that the filename only contains numbers of timestamp
     timestamp = re.findall('\d{2,}', filename)
@@ -912,45 +1403,274 @@ def calc_star_percentage(position, stars, rng, lim=1, unit='deg', weight=False):
     return percentage
 
 
-def calc_cloud_map(stars, rng, img_shape, weight=False):
+def ratescan(img, response, thresholds):
+    '''
+    Returns array of shape (len(thresholds), 4) with one row per threshold containing
+    the fraction of stars with response > threshold (-1 if there are no stars),
+    the number of pixels of img > threshold, the number of clusters of these pixels
+    (4-connected, same as scipy.ndimage.label) and the number of stars with response > threshold.
+
+    Instead of labeling img for every threshold, all counts are taken from sorted arrays.
+    The number of clusters of a threshold is the number of pixels minus the number of edges of a
+    maximum spanning forest of the pixel grid (edge weight = smaller value of both pixels)
+    that are above the threshold.
+    '''
+    thresholds = np.asarray(thresholds, dtype=float)
+    response = np.asarray(response, dtype=float)
+    result = np.empty((len(thresholds), 4))
+
+    visible = np.sort(response[~np.isnan(response)])
+    result[:, 3] = len(visible) - np.searchsorted(visible, thresholds, side='right')
+    result[:, 0] = result[:, 3] / len(response) if len(response) > 0 else -1
+
+    # nothing below the lowest threshold matters
+    with np.errstate(invalid='ignore'):
+        pixels = np.sort(img[img > thresholds.min()])
+    result[:, 1] = len(pixels) - np.searchsorted(pixels, thresholds, side='right')
+
+    # edges between all 4-neighboors, NaN pixels have no edges
+    index = np.arange(img.size).reshape(img.shape)
+    a = np.concatenate([index[:-1, :].ravel(), index[:, :-1].ravel()])
+    b = np.concatenate([index[1:, :].ravel(), index[:, 1:].ravel()])
+    weight = np.minimum(img.ravel()[a], img.ravel()[b])
+    with np.errstate(invalid='ignore'):
+        keep = weight > thresholds.min()
+    a, b, weight = a[keep], b[keep], weight[keep]
+
+    # maximum spanning forest = minimum spanning forest of the edges ranked by descending weight
+    order = np.argsort(-weight, kind='mergesort')
+    rank = np.empty(len(order))
+    rank[order] = np.arange(1, len(order)+1)
+    forest = minimum_spanning_tree(coo_matrix((rank, (a, b)), shape=(img.size, img.size)))
+    forest = np.sort(weight[order[forest.data.astype(int)-1]])
+    result[:, 2] = result[:, 1] - (len(forest) - np.searchsorted(forest, thresholds, side='right'))
+
+    return result
+
+
+def unitVectors(ra, dec):
+    '''
+    Returns cartesian unit vectors of shape (len(ra), 3) for positions on the sphere in radians
+    '''
+    ra = np.atleast_1d(ra)
+    dec = np.atleast_1d(dec)
+    return np.column_stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)])
+
+
+def calc_star_percentages(positions, stars, rng, weight=False):
+    '''
+    Vectorized version of calc_star_percentage(position, stars, rng, unit='deg', lim=-1, weight=weight)
+    for all positions at once. 'positions' needs ra and dec in radians, 'rng' is the radius in degree,
+    either one for all positions or one per position.
+
+    Returns: weighted mean of 'visible' of the stars in range of every position and -1 if no stars in range
+
+    The stars are put into a KD-tree of unit vectors once, an angular distance r is a chord of
+    length 2*sin(r/2). So the costs grow with the number of stars in range, not with the catalogue size.
+    '''
+    ra = np.atleast_1d(np.asarray(positions['ra'], dtype=float))
+    dec = np.atleast_1d(np.asarray(positions['dec'], dtype=float))
+    if len(ra) == 0 or stars.empty:
+        return -np.ones(len(ra))
+    chord = 2*np.sin(np.deg2rad(np.broadcast_to(np.asarray(rng, dtype=float), ra.shape))/2)
+
+    tree = cKDTree(unitVectors(stars.ra.values, stars.dec.values))
+    neighbours = tree.query_ball_point(unitVectors(ra, dec), chord)
+    count = np.array([len(n) for n in neighbours])
+    owner = np.repeat(np.arange(len(ra)), count)
+    index = np.concatenate([np.asarray(n, dtype=int) for n in neighbours])
+
+    if weight:
+        w = np.power(100**(1/5), -stars.vmag.values[index])
+    else:
+        w = np.ones(len(index))
+    vis = np.bincount(owner, weights=w*stars.visible.values[index], minlength=len(ra))
+    total = np.bincount(owner, weights=w, minlength=len(ra))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, vis/total, -1)
+
+
+def splat_gaussians(x, y, weights, grid_shape, factor, sigma):
+    '''
+    Input:  x, y - positions in pixel (arrays)
+            weights - weight of every position (array)
+            grid_shape - shape of the grid, one grid cell covers factor x factor pixels
+            sigma - std of the gaussians in pixel
+    Returns: sum of (unnormalized) gaussians on the grid
+
+    Only the grid cells within 4 sigma of a position are touched, so the cost depends
+    on the number of positions and not on the size of the image.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    weights = np.broadcast_to(np.asarray(weights, dtype=float), x.shape)
+    sigma = sigma / factor
+    offsets = np.arange(-int(np.ceil(4*sigma)), int(np.ceil(4*sigma))+1)
+
+    # grid cell j has its center at pixel (j+0.5)*factor
+    gx = x / factor - 0.5
+    gy = y / factor - 0.5
+    cols = np.round(gx).astype(int)[:, np.newaxis] + offsets
+    rows = np.round(gy).astype(int)[:, np.newaxis] + offsets
+    wx = np.exp(-0.5*((cols - gx[:, np.newaxis])/sigma)**2)
+    wy = np.exp(-0.5*((rows - gy[:, np.newaxis])/sigma)**2)
+    wx[(cols < 0) | (cols >= grid_shape[1])] = 0
+    wy[(rows < 0) | (rows >= grid_shape[0])] = 0
+    cols = cols.clip(0, grid_shape[1]-1)
+    rows = rows.clip(0, grid_shape[0]-1)
+
+    # the footprint of a gaussian is separable
+    w = weights[:, np.newaxis, np.newaxis] * wy[:, :, np.newaxis] * wx[:, np.newaxis, :]
+    index = rows[:, :, np.newaxis] * grid_shape[1] + cols[:, np.newaxis, :]
+    return np.bincount(index.ravel(), w.ravel(), minlength=grid_shape[0]*grid_shape[1]).reshape(grid_shape)
+
+
+def upsample_bilinear(grid, shape, factor):
+    '''
+    Bilinear interpolation of grid (one cell per factor x factor pixels) to an image of size shape
+    '''
+    def taps(n_out, n_in):
+        # position of the pixel centers in grid coordinates
+        c = np.clip((np.arange(n_out) + 0.5) / factor - 0.5, 0, n_in-1)
+        i0 = np.minimum(c.astype(int), max(n_in-2, 0))
+        i1 = np.minimum(i0 + 1, n_in-1)
+        return i0, i1, c - i0
+
+    # interpolate along the columns on the small grid first, then pick whole rows
+    c0, c1, tc = taps(shape[1], grid.shape[1])
+    cols = grid[:, c0] * (1-tc) + grid[:, c1] * tc
+    r0, r1, tr = taps(shape[0], grid.shape[0])
+    out = cols[r0]
+    out *= (1-tr)[:, np.newaxis]
+    out += cols[r1] * tr[:, np.newaxis]
+    return out
+
+
+def calc_cloud_map(stars, rng, img_shape, weight=False, factor=None):
     '''
     Input:  stars - pandas dataframe
             rng - sigma of gaussian kernel (integer)
             img_shape - size of cloudiness map in pixel (tuple)
             weight - use magnitude as weight or not (boolean)
+            factor - downsampling factor of the grid the density maps get calculated on.
+                Default: rng//2
     Returns: Cloudines map of the sky. 1=cloud, 0=clear sky
 
     Cloudiness is percentage of visible stars in local area. Stars get weighted by
     distance (gaussian) and star magnitude 2.5^magnitude.
-    Instead of a computationally expensive for-loop we use two 2D histograms of the stars (weighted)
-    and convolve them with an gaussian kernel resulting in some kind of 'density map'.
-    Division of both maps yields the desired cloudines map.
+    Both density maps (visible stars and all stars) are sums of gaussians around the stars
+    on a downsampled grid (see splat_gaussians). Division of both maps yields the cloudiness,
+    which gets upsampled to img_shape with bilinear interpolation.
+    See CloudMapper for a version that caches the density of all stars.
+    '''
+    if factor is None:
+        factor = max(1, int(rng)//2)
+    grid_shape = (-(-img_shape[0]//factor), -(-img_shape[1]//factor))
+    w = 2.5**-stars.vmag.values if weight else np.ones(len(stars.index))
+    density_visible = splat_gaussians(stars.x.values, stars.y.values, w*stars.visible.values, grid_shape, factor, rng)
+    density_all = splat_gaussians(stars.x.values, stars.y.values, w, grid_shape, factor, rng)
+    return cloudiness(density_visible, density_all, img_shape, factor)
+
+
+def cloudiness(density_visible, density_all, img_shape, factor):
+    '''
+    Returns 1 - density_visible/density_all upsampled to img_shape. 0 where there are no stars.
     '''
-    if weight:
-        scattered_stars_visible,_,_ = np.histogram2d(x=stars.y.values, y=stars.x.values, weights=stars.visible.values * 2.5**-stars.vmag.values, bins=img_shape, range=[[0,img_shape[0]],[0,img_shape[1]]])
-        scattered_stars,_,_ = np.histogram2d(stars.y.values, stars.x.values, weights=np.ones(len(stars.index)) * 2.5**-stars.vmag.values, bins=img_shape, range=[[0,img_shape[0]],[0,img_shape[1]]])
-        density_visible = skimage.filters.gaussian(scattered_stars_visible, rng)
-        density_all = skimage.filters.gaussian(scattered_stars, rng)
-    else:
-        scattered_stars_visible,_,_ = np.histogram2d(x=stars.y.values, y=stars.x.values, weights=stars.visible.values, bins=img_shape, range=[[0,img_shape[0]],[0,img_shape[1]]])
-        scattered_stars,_,_ = np.histogram2d(stars.y.values, stars.x.values, weights=np.ones(len(stars.index)), bins=img_shape, range=[[0,img_shape[0]],[0,img_shape[1]]])
-        density_visible = skimage.filters.gaussian(scattered_stars_visible, rng, mode='mirror')
-        density_all = skimage.filters.gaussian(scattered_stars, rng, mode='mirror')
     with np.errstate(divide='ignore',invalid='ignore'):
         cloud_map = np.true_divide(density_visible, density_all)
-        cloud_map[~np.isfinite(cloud_map)] = 0
-    return 1-cloud_map
+    cloud_map[~np.isfinite(cloud_map) | (density_all <= 0)] = 0
+    return 1-upsample_bilinear(cloud_map.clip(0, 1), img_shape, factor)
 
 
+class CloudMapper:
+    '''
+    Cloud maps of one camera (see calc_cloud_map) with a cached density of all stars.
+
+    The density of all catalogue stars that are above the altitude limit, within the image
+    and not cropped only depends on the sidereal time. It gets calculated at nodes every
+    'node_step' radians of sidereal time (default: stars move sigma/4 pixel) and linearly
+    interpolated in between. Stars of this reference that are missing in the star table of an
+    image (e.g. close to the moon or not found) get subtracted, so per image only the visible stars
+    and the missing ones have to be splatted.
+    '''
+    def __init__(self, geometry, img_shape, sigma, crop_mask=None, weight=True, factor=None, node_step=None, cache_size=4):
+        self.geometry = geometry
+        self.img_shape = tuple(img_shape)
+        self.sigma = sigma
+        self.factor = factor or max(1, int(sigma)//2)
+        self.grid_shape = (-(-self.img_shape[0]//self.factor), -(-self.img_shape[1]//self.factor))
+        self.crop_mask = crop_mask
+        self.weight = weight
+        self.weights = 2.5**-geometry.vmag if weight else np.ones(len(geometry.vmag))
+        if node_step is None:
+            # a star at the celestial equator moves sigma/4 pixel between two nodes at zenith
+            node_step = sigma / 4 / (geometry.radius / (np.pi/2))
+        self.node_step = node_step
+        self.cache_size = cache_size
+        self.nodes = OrderedDict()
+
+    def node(self, k):
+        '''
+        Returns density of all reference stars at sidereal time k*node_step, the mask of
+        the geometry rows that are part of the reference and x, y of all rows
+        '''
+        try:
+            self.nodes.move_to_end(k)
+            return self.nodes[k]
+        except KeyError:
+            pass
+        az, alt, x, y = self.geometry.positions_at(k * self.node_step)
+        res = self.geometry.resolution
+        keep = (alt > self.geometry.min_altitude) & (0 < x) & (x < res[0]) & (0 < y) & (y < res[1])
+        if self.crop_mask is not None:
+            keep[keep] = ~isCropped(self.crop_mask, x[keep], y[keep])
+        density = splat_gaussians(x[keep], y[keep], self.weights[keep], self.grid_shape, self.factor, self.sigma)
+        self.nodes[k] = (density, keep, x, y)
+        while len(self.nodes) > self.cache_size:
+            self.nodes.popitem(last=False)
+        return self.nodes[k]
+
+    def density_all(self, stars, sidereal_time):
+        '''
+        Returns density of all stars in star table 'stars' (index HIP) at sidereal_time
+        '''
+        present = np.isin(self.geometry.hip, stars.index.values)
+        k = int(np.floor(sidereal_time / self.node_step))
+        t = sidereal_time / self.node_step - k
+        density = np.zeros(self.grid_shape)
+        for node, weight in ((k, 1-t), (k+1, t)):
+            reference, keep, x, y = self.node(node)
+            # stars that differ between the reference and the star table are splatted at the node positions
+            missing = keep & ~present
+            additional = present & ~keep
+            density += weight * (reference
+                    - splat_gaussians(x[missing], y[missing], self.weights[missing], self.grid_shape, self.factor, self.sigma)
+                    + splat_gaussians(x[additional], y[additional], self.weights[additional], self.grid_shape, self.factor, self.sigma))
+        return density
+
+    def cloud_map(self, stars, sidereal_time):
+        '''
+        Returns cloudiness map of the sky (see calc_cloud_map) for star table 'stars'
+        (index HIP) of an image taken at sidereal_time
+        '''
+        w = 2.5**-stars.vmag.values if self.weight else np.ones(len(stars.index))
+        density_visible = splat_gaussians(stars.x.values, stars.y.values, w * stars.visible.values,
+                self.grid_shape, self.factor, self.sigma)
+        return cloudiness(density_visible, self.density_all(stars, sidereal_time), self.img_shape, self.factor)
+
 
 def filter_catalogue(catalogue, rng):
     '''
-    Loop through all possible pairs of stars and remove less bright star if distance is < rng
+    Remove less bright star of all pairs of stars with distance < rng
 
     Input:  catalogue - Pandas dataframe (ra and dec in degree)
             rng - Min distance between stars in degree
 
-    Returns: List of indexes that remain in catalogue
+    Returns: List of indexes that remain in catalogue (sorted by vmag)
+
+    All pairs closer than rng are found at once with a KD-tree of unit vectors
+    (chord length 2*sin(rng/2)). Then stars are processed from bright to faint and
+    every star that was not removed before removes its fainter neighboors.
     '''
     log = logging.getLogger(__name__)
     try:
@@ -960,17 +1680,21 @@ def filter_catalogue(catalogue, rng):
     except KeyError:
         log.error('Key not found. Please check that your catalogue is labeled correctly')
         raise
-    
-    i1 = 0 #star index that is used as filter base
-    while i1 < len(reference)-1:
-        print('Items left: {}/{}'.format(i1,len(reference)-1))
-        deltaDeg = np.rad2deg(2*np.arcsin(np.sqrt(np.sin((reference[i1,1]-reference[:,1])/2)**2 + np.cos(reference[i1,1])*np.cos(reference[:,1])*np.sin((reference[i1,0]-reference[:,0])/2)**2)))
-        keep = deltaDeg > rng
-        keep[:i1+1] = True #don't remove stars that already passed the filter
-        reference = reference[keep]
-        index = index[keep]
-        i1+=1
-    return index
+
+    tree = cKDTree(unitVectors(reference[:,0], reference[:,1]))
+    pairs = tree.query_pairs(2*np.sin(np.deg2rad(rng)/2), output_type='ndarray')
+
+    # neighboors of each star that are fainter (pairs are sorted by vmag already: i < j)
+    pairs = np.sort(pairs, axis=1)
+    pairs = pairs[np.argsort(pairs[:,0], kind='mergesort')]
+    start = np.searchsorted(pairs[:,0], np.arange(len(index)+1))
+
+    removed = np.zeros(len(index), dtype=bool)
+    for i in range(len(index)):
+        if not removed[i]:
+            removed[pairs[start[i]:start[i+1], 1]] = True
+    log.debug('Removed {} of {} stars'.format(np.sum(removed), len(index)))
+    return index[~removed]
 
 
 def process_image(images, data, config, args):
@@ -978,14 +1702,20 @@ def process_image(images, data, config, args):
     This function applies all neccessary calculations to an image and returns the results.
     Use it in the main loop!
     '''
-    log = logging.getLogger(__name__)
-
-    output = dict()
     if not images:
         return
 
+    # the profiler stops tracing memory even if a stage raises
+    with StageProfiler(images['timestamp'], enabled=bool(args['--profile'])) as profiler:
+        return _process_image(images, data, config, args, profiler)
+
+
+def _process_image(images, data, config, args, profiler):
+    log = logging.getLogger(__name__)
 
+    output = dict()
     log.info('Processing image taken at: {}'.format(images['timestamp']))
+    profiler.start('setup')
     observer = obs_setup(config['properties'])
     observer.date = images['timestamp']
     data['timestamp'] = images['timestamp']
@@ -1016,10 +1746,17 @@ def process_image(images, data, config, args):
         output['hash'] = sha1(np.ascontiguousarray(images['img']).data).hexdigest()
         
 
+    # all filters work on a writable float copy of the image (single precision with --float32),
+    # memory mapped images get read only once while converting
+    dtype = np.float32 if args['--float32'] else np.float64
+    if images['img'].dtype != dtype or not images['img'].flags.writeable:
+        images['img'] = images['img'].astype(dtype)
+
     # create cropping array to mask unneccessary image regions.
     crop_mask = get_crop_mask(images['img'], config['crop'])
 
     # update celestial objects (ignore planets, because they are bigger than stars and mess up the detection)
+    profiler.start('geometry')
     celObjects = update_star_position(data, observer, config, crop_mask, args)
     stars = pd.concat([celObjects['stars'],])# celObjects['planets']])
     if stars.empty:
@@ -1032,69 +1769,71 @@ def process_image(images, data, config, args):
     img = images['img']
     
     # calculate response of stars
+    profiler.start('filter')
     if args['--kernel']:
-        kernelSize = float(args['--kernel']),
-        #np.arange(1, int(args['--kernel'])+1, 5)
+        kernelSize = [float(k) for k in split('\\s*,\\s*', args['--kernel'])]
         stars_orig = stars.copy()
     else:
         kernelSize = [float(config['analysis']['kernelsize'])]
     kernelResults = list()
 
-    for k in kernelSize:
-        log.debug('Apply image filters. Kernelsize = {}'.format(k))
+    # tolerance is max distance between actual star position and expected star position
+    # this should be a little smaller than 1° because this is the minimum distance
+    # between 2 catalogue stars (catalogue was filtered for this)
+    tolerance = np.max([0, int((float(config['image']['radius'])/90-1)/2)])
+
+    # calculate the response for all kernel sizes at once, Grad and Sobel don't depend on the kernel
+    log.debug('Apply image filters. Kernelsizes = {}'.format(kernelSize))
+    if args['--function'] == 'All' or args['--ratescan']:
+        grad = (img - np.roll(img, 1, axis=0)).clip(min=0)**2 + (img - np.roll(img, 1, axis=1)).clip(min=0)**2
+        sobel = skimage.filters.sobel(img).clip(min=0).astype(img.dtype, copy=False)
+        grad[crop_mask] = np.NaN
+        sobel[crop_mask] = np.NaN
+        responses = filterBank(img, kernelSize, 'LoG')
+        responses[:, crop_mask] = np.NaN
+        lap = responses[-1]
+        images['grad'] = grad
+        images['sobel'] = sobel
+        images['lap'] = lap
+        stars_grad = pd.Series(findLocalMax(grad, stars.x.values, stars.y.values, tolerance)[2], index=stars.index)
+        stars_sobel = pd.Series(findLocalMax(sobel, stars.x.values, stars.y.values, tolerance)[2], index=stars.index)
+    elif args['--function'] in ('DoG', 'LoG'):
+        responses = filterBank(img, kernelSize, args['--function'])
+        responses[:, crop_mask] = np.NaN
+    elif args['--function'] == 'Grad':
+        resp = ((img - np.roll(img, 1, axis=0)).clip(min=0))**2 + ((img - np.roll(img, 1, axis=1)).clip(min=0))**2
+        resp[crop_mask] = np.NaN
+        responses = resp[np.newaxis]
+    elif args['--function'] == 'Sobel':
+        resp = skimage.filters.sobel(img).clip(min=0).astype(img.dtype, copy=False)
+        resp[crop_mask] = np.NaN
+        responses = resp[np.newaxis]
+    else:
+        log.error('Function name: \'{}\' is unknown!'.format(args['--function']))
+        sys.exit(1)
+    images['response'] = responses[-1]
 
+    # calculate x and y position where response has its max value (search within 'tolerance' range)
+    profiler.start('sampling')
+    # and the response itself for all stars and kernels at once
+    log.debug('Calculate Filter response')
+    maxX, maxY, maxValue = findLocalMax(responses, stars.x.values, stars.y.values, tolerance)
+
+    for n, k in enumerate(kernelSize):
         # undo all changes, if we are in a loop
         if len(kernelSize) > 1:
             stars = stars_orig.copy()
         stars['kernel'] = k
 
-        gauss = skimage.filters.gaussian(img, sigma=k)
-
-        # chose the response function
-        if args['--function'] == 'All' or args['--ratescan']:
-            grad = (img - np.roll(img, 1, axis=0)).clip(min=0)**2 + (img - np.roll(img, 1, axis=1)).clip(min=0)**2
-            sobel = skimage.filters.sobel(img).clip(min=0)
-            lap = skimage.filters.laplace(gauss, ksize=3).clip(min=0)
-
-            grad[crop_mask] = np.NaN
-            sobel[crop_mask] = np.NaN
-            lap[crop_mask] = np.NaN
-            images['grad'] = grad
-            images['sobel'] = sobel
-            images['lap'] = lap
-            resp = lap
-        elif args['--function'] == 'DoG':
-            resp = skimage.filters.gaussian(img, sigma=k) - skimage.filters.gaussian(img, sigma=1.6*k)
-        elif args['--function'] == 'LoG':
-            resp = skimage.filters.laplace(gauss, ksize=3).clip(min=0)
-        elif args['--function'] == 'Grad':
-            resp = ((img - np.roll(img, 1, axis=0)).clip(min=0))**2 + ((img - np.roll(img, 1, axis=1)).clip(min=0))**2
-        elif args['--function'] == 'Sobel':
-            resp = skimage.filters.sobel(img).clip(min=0)
-        else:
-            log.error('Function name: \'{}\' is unknown!'.format(args['--function']))
-            sys.exit(1)
-        resp[crop_mask] = np.NaN
-        images['response'] = resp
-
-
-        # tolerance is max distance between actual star position and expected star position
-        # this should be a little smaller than 1° because this is the minimum distance
-        # between 2 catalogue stars (catalogue was filtered for this)
-        tolerance = np.max([0, int((float(config['image']['radius'])/90-1)/2)])
-        log.debug('Calculate Filter response')
-        
-        # calculate x and y position where response has its max value (search within 'tolerance' range)
-        stars = pd.concat([stars.drop(['maxX','maxY'], errors='ignore', axis=1), stars.apply(
-                lambda s : findLocalMaxPos(resp, s.x, s.y, tolerance),
-                axis=1)], axis=1
-        )
+        # kernel independent functions have only one response
+        j = min(n, len(responses)-1)
+        resp = responses[j]
+        stars['maxX'], stars['maxY'], stars['response'] = maxX[j], maxY[j], maxValue[j]
 
         # drop stars that got mistaken for a brighter neighboor
         stars = stars.sort_values('vmag').drop_duplicates(subset=['maxX', 'maxY'], keep='first')
 
-        # calculate response and drop stars that were not found at all, because response=0 interferes with log-plot
-        stars['response'] = stars.apply(lambda s : findLocalMaxValue(resp, s.x, s.y, tolerance), axis=1)
+        # drop stars that were not found at all, because response=0 interferes with log-plot
         #stars['response_mean'] = stars.apply(lambda s : findLocalMean(resp, s.x, s.y, tolerance*2), axis=1)
         #stars['response_std'] = stars.apply(lambda s : findLocalStd(resp, s.x, s.y, tolerance*2), axis=1)
         stars.query('response > 1e-100', inplace=True)
@@ -1105,8 +1844,8 @@ def process_image(images, data, config, args):
         stars['response'] = stars.response / transmission3(stars.altitude, 1.0, float(lim[0]))
         
         if args['--function'] == 'All' or args['--ratescan']:
-            stars['response_grad'] = stars.apply(lambda s : findLocalMaxValue(grad, s.x, s.y, tolerance), axis=1)
-            stars['response_sobel'] = stars.apply(lambda s : findLocalMaxValue(sobel, s.x, s.y, tolerance), axis=1)
+            stars['response_grad'] = stars_grad
+            stars['response_sobel'] = stars_sobel
         lim = (split('\\s*,\\s*', config['analysis']['visibleupperlimit']), split('\\s*,\\s*', config['analysis']['visiblelowerlimit']))
 
         # calculate visibility percentage
@@ -1125,7 +1864,17 @@ def process_image(images, data, config, args):
         # set visible = 0 for all magnitudes where upperLimit < lowerLimit
         stars.loc[stars.vmag.values > (float(lim[1][1]) - float(lim[0][1])) / (float(lim[0][0]) - float(lim[1][0])), 'visible'] = 0
 
-        #stars['blobSize'] = stars.apply(lambda s : getBlobsize(resp[s.maxY-25:s.maxY+26, s.maxX-25:s.maxX+26], s.response*0.1), axis=1)
+        # size of the blob around every star (only on request, it is not needed for the analysis),
+        # in chunks because of the window size
+        if args['--blobsize']:
+            step = 1000
+            stars['blobSize'] = np.concatenate([np.zeros(0, dtype=int)] + [
+                getBlobsizes(
+                    getLocalWindows(resp, stars.maxX.values[i:i+step], stars.maxY.values[i:i+step], 25)[0],
+                    stars.response_orig.values[i:i+step]*0.1,
+                )
+                for i in range(0, len(stars.index), step)
+            ])
 
         # append results
         kernelResults.append(stars)
@@ -1145,10 +1894,10 @@ def process_image(images, data, config, args):
     celObjects['stars'].reset_index(0, drop=True, inplace=True)
     stars = celObjects['stars']
 
+    profiler.start('points_of_interest')
     if len(kernelSize) == 1:
-        celObjects['points_of_interest']['starPercentage'] = celObjects['points_of_interest'].apply(
-                lambda p,stars=stars : calc_star_percentage(p, stars, p.radius, unit='deg', lim=-1, weight=True),
-                axis=1)
+        celObjects['points_of_interest']['starPercentage'] = calc_star_percentages(
+                celObjects['points_of_interest'], stars, celObjects['points_of_interest'].radius.values, weight=True)
     else:
         log.warning('Can not process points_of_interest if multiple kernel sizes get used')
     output['global_star_perc'] = calc_star_percentage({'altitude': np.pi/2, 'azimuth':0}, stars, float(config['image']['openingangle']), unit='deg', lim=-1, weight=True)
@@ -1156,94 +1905,14 @@ def process_image(images, data, config, args):
     
     ##################################
 
-    if args['--cam'] or args['--daemon']:
-        output['img'] = img
-        fig = plt.figure(figsize=(16,9))
-        vmin = np.nanpercentile(img, 5)
-        vmax = np.nanpercentile(img, 90.)
-        plt.imshow(img, vmin=vmin,vmax=vmax, cmap='gray')
-        stars.plot.scatter(x='x',y='y', ax=plt.gca(), c='visible', cmap = plt.cm.RdYlGn, s=30, vmin=0, vmax=1, grid=True)
-        celObjects['points_of_interest'].plot.scatter(x='x', y='y', ax=plt.gca(), s=80, color='white', marker='^', label='Sources')
-        plt.colorbar()
-        plt.tight_layout()
-
-        if args['-s']:
-            plt.savefig('cam_image_{}.pdf'.format(images['timestamp'].isoformat()))
-        if args['--daemon']:
-            plt.savefig('cam_image_{}.png'.format(config['properties']['name']),dpi=300)
-        if args['-v']:
-            plt.show()
-        plt.close('all')
-
     if args['--single'] or args['--daemon']:
-        if args['--response'] or args['--daemon']:
-            fig = plt.figure(figsize=(16,9))
-            ax = plt.subplot(111)
-            ax.semilogy()
-
-            # draw visibility limits
-            x = np.linspace(-5+stars.vmag.min(), stars.vmag.max()+5, 20)
-            lim = (list(map(float, split('\\s*,\\s*', config['analysis']['visibleupperlimit']))), 
-                    list(map(float, split('\\s*,\\s*', config['analysis']['visiblelowerlimit']))))
-            y1 = 10**(x*lim[1][0] + lim[1][1])
-            y2 = 10**(x*lim[0][0] + lim[0][1])
-            ax.plot(x, y1, c='red', label='lower limit')
-            ax.plot(x, y2, c='green', label='upper limit')
-
-            stars.plot.scatter(x='vmag', y='response', ax=ax, logy=True, c=stars.visible.values,
-                    cmap = plt.cm.RdYlGn, grid=True, vmin=0, vmax=1, label='Kernel Response')
-            ax.set_xlim((-1, max(stars['vmag'])+0.5))
-            ax.set_ylim((10**(lim[1][1]-1),10**(lim[0][1]+1)))
-            ax.set_ylabel('Kernel Response')
-            ax.set_xlabel('Star Magnitude')
-            if args['-c'] == 'GTC':
-                if args['--function'] == 'Grad':
-                    ax.axhspan(ymin=11**2/255**2, ymax=13**2/255**2, color='red', alpha=0.5, label='old threshold range')
-                ax.axvline(4.5, color='black', label='Magnitude lower limit')
-
-            # show camera image in a subplot
-            ax_in= inset_axes(ax,
-                    width='30%',
-                    height='40%',
-                    loc=3)
-            vmin = np.nanpercentile(img, 0.5)
-            vmax = np.nanpercentile(img, 99.)
-            ax_in.imshow(img,cmap='gray',vmin=vmin,vmax=vmax)
-            color = cm.RdYlGn(stars.visible.values)
-            stars.plot.scatter(x='x',y='y', ax=ax_in, c=color, vmin=0, vmax=1, grid=True)
-            ax_in.get_xaxis().set_visible(False)
-            ax_in.get_yaxis().set_visible(False)
-            
-            ax.legend(loc='best')
-            if args['-s']:
-                plt.savefig('response_{}_{}.png'.format(args['--function'], images['timestamp'].isoformat()))
-            if args['--daemon']:
-                plt.savefig('response_{}.png'.format(config['properties']['name']),dpi=200)
-            if args['-v']:
-                plt.show()
-            plt.close('all')
-
         if args['--ratescan']:
+            profiler.start('ratescan')
             log.info('Doing ratescan')
-            gradList = list()
-            sobelList = list()
-            lapList = list()
-
             response = np.logspace(-4.5,-0.5,200)
-            for resp in response:
-                labeled, labelCnt = label(grad>resp)
-                stars['visible'] = stars.response_grad > resp
-                gradList.append((calc_star_percentage(0, stars, -1), np.sum(grad > resp), labelCnt, sum(stars.visible)))
-                labeled, labelCnt = label(sobel>resp)
-                stars['visible'] = stars.response_sobel > resp
-                sobelList.append((calc_star_percentage(0, stars, -1), np.sum(sobel > resp), labelCnt, sum(stars.visible)))
-                labeled, labelCnt = label(lap>resp)
-                stars['visible'] = stars.response > resp
-                lapList.append((calc_star_percentage(0, stars, -1), np.sum(lap > resp), labelCnt, sum(stars.visible)))
-
-            gradList = np.array(gradList)
-            sobelList = np.array(sobelList)
-            lapList = np.array(lapList)
+            gradList = ratescan(grad, stars.response_grad.values, response)
+            sobelList = ratescan(sobel, stars.response_sobel.values, response)
+            lapList = ratescan(lap, stars.response.values, response)
 
             #minThresholds = [max(response[l[:,0]==1]) for l in (gradList, sobelList, lapList)]
 
@@ -1290,32 +1959,28 @@ def process_image(images, data, config, args):
             del sobel
             del lap
 
+    cloud_map = None
     if args['--cloudmap'] or args['--cloudtrack'] or args['--daemon']:
+        profiler.start('cloudmap')
         log.debug('Calculating cloud map')
-        cloud_map = calc_cloud_map(stars, img.shape[1]//80, img.shape, weight=True)
+        # the mapper only has to be set up once per camera
+        if 'cloud_mapper' not in data:
+            data['cloud_mapper'] = CloudMapper(data['geometry'], img.shape, img.shape[1]//80,
+                    crop_mask=get_crop_mask(img, config['crop']), weight=True)
+        cloud_map = data['cloud_mapper'].cloud_map(stars, float(observer.sidereal_time()))
         cloud_map[crop_mask] = 1
         if args['--cloudtrack']:
             output['cloudmap'] = cloud_map
-        if args['--cloudmap']:
-            ax1 = plt.subplot(121)
-            vmin = np.nanpercentile(img, 5.5)
-            vmax = np.nanpercentile(img, 99.9)
-            ax1.imshow(img, vmin=vmin, vmax=vmax, cmap='gray', interpolation='none')
-            ax1.grid()
-
-            ax2 = plt.subplot(122)
-            ax2.imshow(cloud_map, cmap='gray_r', vmin=0, vmax=1)
-            ax2.grid()
-            if args['-s']:
-                plt.savefig('cloudMap_{}.png'.format(images['timestamp'].isoformat()))
-            if args['-v']:
-                plt.show()
-            plt.close('all')
-        if args['--daemon']:
-            ax = plt.subplot(111)
-            ax.imshow(cloud_map, cmap='gray_r', vmin=0, vmax=1)
-            ax.grid()
-            plt.savefig('cloudMap_{}.png'.format(config['properties']['name']),dpi=200)
+
+    # plots get rendered by plotting.Renderer of the consumer of output, only interactive ones here
+    profiler.start('plotting')
+    record = plotting.plot_record(img, stars, celObjects['points_of_interest'], cloud_map, config, args, images['timestamp'])
+    if record is not None:
+        if args['-v']:
+            plotting.show(record)
+        if any(filename for _, filename, _ in record['targets']):
+            output['plot'] = record
+
     try:
         output['global_coverage'] = np.nanmean(cloudmap)
     except NameError:
@@ -1330,6 +1995,7 @@ def process_image(images, data, config, args):
     output['moon_phase'] = celObjects['moon']['moonPhase']
 
     if args['--sql']:
+        profiler.start('sql')
         try:
             sql.writeSQL(config, output)
         except (OperationalError):
@@ -1337,6 +2003,15 @@ def process_image(images, data, config, args):
         except InternalError as e:
             log.error('Error while writing to SQL server: {}'.format(e))
 
+    # the result store gets all stages but its own
+    profiler.stop()
+    if profiler.enabled:
+        output['profile'] = profiler.records
+
+    if args['--store']:
+        profiler.start('store')
+        ResultStore(args['--store'], config['properties']['name']).append(output)
+    profiler.stop()
 
     if args['--low-memory']:
         slimOutput = dict()
@@ -1345,13 +2020,17 @@ def process_image(images, data, config, args):
                 slimOutput[key] = [output[key]]
             except KeyError:
                 log.warning('Key {} was not found in dataframe so it can not be returned/stored'.format(key))
+        for key in ['plot', 'profile']:
+            if key in output:
+                slimOutput[key] = output[key]
         del output
         output = slimOutput
         del slimOutput
                 
     if args['--daemon']:
-        del output
-        output = None
+        # the cloud tracker of the daemon only needs the cloud map
+        # the renderer only the plots and the run profile only the stage timings
+        output = {key: output[key] for key in ['timestamp', 'cloudmap', 'plot', 'profile'] if key in output}
 
     log.info('Done')
     return output
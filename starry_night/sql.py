@@ -1,9 +1,12 @@
 from sqlalchemy import Column, Integer, String, VARCHAR, DateTime, Float, ForeignKey, create_engine, MetaData
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from sqlalchemy.exc import IntegrityError, InvalidRequestError, OperationalError
+from multiprocessing.util import Finalize
 import logging
-from IPython import embed
+import os
+import threading
+import time
 
 
 Base = declarative_base()
@@ -37,48 +40,143 @@ class SqlPoiEntry(Base):
     starPerc = Column(Float)
 
 
-def writeSQL(config, data):
-    log = logging.getLogger(__name__)
-    log.debug('Create SQL engine')
-    engine = create_engine(config['SQL']['connection'])
-    sMaker = sessionmaker(bind=engine)
-    session = sMaker()
-    
-    session.add(SqlEntry(
-                    timestamp=data['timestamp'],
-                    hashsum=data['hash'],
-                    sunAlt=data['sun_alt'],
-                    moonAlt=data['moon_alt'],
-                    moonPhase=data['moon_phase'],
-                    brightnessMean=data['brightness_mean'].item(),
-                    brightnessStd=data['brightness_std'].item(),
-                    global_star_perc = data['global_star_perc'].item(),
-                    global_coverage = data['global_coverage'].item()
-                )
-    )
-
-    Base.metadata.create_all(engine)
-    log.debug('Commit SQL Part 1')
-    try:
-        session.commit()
-    except (IntegrityError, InvalidRequestError) as e:
+class SqlWriter:
+    '''
+    Long lived writer for the results of process_image.
+
+    The engine (and its connection pool) and the schema get created once.
+    Results are buffered and written with bulk inserts as soon as 'batch_size'
+    images are buffered or the last flush is older than 'flush_interval' seconds (0 = never).
+    The age of the last flush is also checked by a background thread every 'flush_interval'
+    seconds, so buffered results of a slow stream of images do not wait for the next image.
+    Any SQLAlchemy connection string works, e.g. 'sqlite://' for testing without a server.
+    '''
+    def __init__(self, connection, batch_size=1, flush_interval=0, max_pending=1000):
+        self.engine = create_engine(connection, pool_pre_ping=True, pool_recycle=3600)
+        Base.metadata.create_all(self.engine)
+        self.sMaker = sessionmaker(bind=self.engine)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = list()
+        self.last_flush = time.time()
+        self.lock = threading.RLock()
+
+        # flush remaining entries when the process (or pool worker) exits
+        Finalize(None, self.flush, exitpriority=10)
+        if flush_interval > 0:
+            threading.Thread(target=self.flush_periodically, name='sql-flush', daemon=True).start()
+
+    def flush_periodically(self):
+        '''
+        Flush if the last flush is older than flush_interval, runs in a background thread forever
+        '''
         log = logging.getLogger(__name__)
-        log.error(e)
-    except AttributeError as e:
-        log.error(e)
-        log.error('You might need to hand np.float64.item() to SQL writer because this will return pythons native float object')
-        sys.exit(1)
-
-
-    for i, poi in data['points_of_interest'].iterrows():
-        session.add(SqlPoiEntry(timestamp=data['timestamp'], ID=poi.ID, ra=poi.ra, dec=poi.dec, starPerc=poi.starPercentage))
-    Base.metadata.create_all(engine)
-    log.debug('Commit SQL Part 2')
-    try:
-        session.commit()
-    except (IntegrityError, InvalidRequestError) as e:
-        log.error(e)
-    except AttributeError as e:
-        log.error(e)
-        log.error('You might need to hand np.float64.item() to SQL writer because this will return pythons native float object')
-        sys.exit(1)
+        while True:
+            time.sleep(self.flush_interval)
+            with self.lock:
+                if time.time() - self.last_flush < self.flush_interval:
+                    continue
+                try:
+                    self.flush()
+                except OperationalError as e:
+                    log.error('Writing to SQL server failed, entries are kept for the next try: {}'.format(e))
+
+    def add(self, data):
+        '''
+        Buffer the output dictionary of process_image and flush if batch is complete
+        '''
+        entry = dict(
+                timestamp=data['timestamp'],
+                hashsum=data['hash'],
+                sunAlt=float(data['sun_alt']),
+                moonAlt=float(data['moon_alt']),
+                moonPhase=float(data['moon_phase']),
+                brightnessMean=float(data['brightness_mean']),
+                brightnessStd=float(data['brightness_std']),
+                global_star_perc=float(data['global_star_perc']),
+                global_coverage=float(data['global_coverage']),
+        )
+        pois = [dict(
+                timestamp=data['timestamp'],
+                ID=int(ID),
+                ra=float(ra),
+                dec=float(dec),
+                starPerc=float(starPerc),
+            ) for ID, ra, dec, starPerc in zip(
+                data['points_of_interest'].ID.values,
+                data['points_of_interest'].ra.values,
+                data['points_of_interest'].dec.values,
+                data['points_of_interest'].starPercentage.values,
+            )
+        ]
+        with self.lock:
+            self.pending.append((entry, pois))
+
+            if len(self.pending) > self.max_pending:
+                log = logging.getLogger(__name__)
+                log.warning('More than {} entries could not be written to SQL. Dropping oldest entry'.format(self.max_pending))
+                self.pending.pop(0)
+
+            if len(self.pending) >= self.batch_size or (
+                    self.flush_interval > 0 and time.time() - self.last_flush >= self.flush_interval):
+                self.flush()
+
+    def flush(self):
+        '''
+        Write all buffered entries with bulk inserts.
+        If this fails because of duplicates, entries get written one by one so
+        only the duplicates get lost.
+        If the server is not available, entries stay in the buffer for the next try.
+        '''
+        with self.lock:
+            if not self.pending:
+                return
+            log = logging.getLogger(__name__)
+            log.debug('Write {} entries to SQL'.format(len(self.pending)))
+
+            session = self.sMaker()
+            try:
+                session.bulk_insert_mappings(SqlEntry, [entry for entry, _ in self.pending])
+                session.bulk_insert_mappings(SqlPoiEntry, [poi for _, pois in self.pending for poi in pois])
+                session.commit()
+            except (IntegrityError, InvalidRequestError) as e:
+                session.rollback()
+                log.debug('Bulk insert failed, inserting entries one by one: {}'.format(e))
+                for entry, pois in self.pending:
+                    for table, rows in ((SqlEntry, [entry]), (SqlPoiEntry, pois)):
+                        try:
+                            session.bulk_insert_mappings(table, rows)
+                            session.commit()
+                        except (IntegrityError, InvalidRequestError) as e:
+                            session.rollback()
+                            log.error(e)
+            except OperationalError:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+            self.pending = list()
+            self.last_flush = time.time()
+
+
+_writers = dict()
+
+def get_writer(config):
+    '''
+    Returns the SqlWriter of this process for the connection in config['SQL'].
+    Optional config keys 'batch_size' and 'flush_interval' control batching.
+    '''
+    key = (os.getpid(), config['SQL']['connection'])
+    if key not in _writers:
+        _writers[key] = SqlWriter(
+                config['SQL']['connection'],
+                batch_size=config['SQL'].getint('batch_size', fallback=1),
+                flush_interval=config['SQL'].getfloat('flush_interval', fallback=0),
+        )
+    return _writers[key]
+
+
+def writeSQL(config, data):
+    get_writer(config).add(data)
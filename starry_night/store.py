@@ -0,0 +1,132 @@
+import pandas as pd
+import numpy as np
+import logging
+import os
+import socket
+from glob import glob
+from datetime import timedelta
+
+
+class ResultStore:
+    '''
+    Append only HDF5 store for the results of process_image.
+
+    Results are partitioned by camera and night:
+
+        <path>/<camera>/<night>/part-<host>-<pid>.h5
+
+    Every process writes its own part file, so workers of a Pool can append in parallel.
+    Each part file contains the tables 'stars' (one row per star and image),
+    'global' (one row per image), 'points_of_interest' and 'profile' (one row per
+    processing stage and image, only if profiling was enabled).
+    Timestamp, HIP and altitude are stored as data columns, so reading can be
+    restricted to a time range, some stars or an altitude band without loading everything.
+    '''
+    def __init__(self, path, camera):
+        self.path = path
+        self.camera = camera
+
+    @staticmethod
+    def night(timestamp):
+        '''
+        Returns the night of timestamp as 'YYYY-MM-DD' of the evening the night started
+        '''
+        return (pd.Timestamp(timestamp) - timedelta(hours=12)).strftime('%Y-%m-%d')
+
+    def part_file(self, timestamp):
+        directory = os.path.join(self.path, self.camera, self.night(timestamp))
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, 'part-{}-{}.h5'.format(socket.gethostname(), os.getpid()))
+
+    def append(self, output):
+        '''
+        Append the output dictionary of process_image to the store
+        '''
+        timestamp = pd.Timestamp(output['timestamp'])
+
+        stars = output['stars'].select_dtypes(include=[np.number]).reset_index()
+        stars.insert(0, 'timestamp', timestamp)
+
+        glob_row = pd.DataFrame({
+            'timestamp': [timestamp],
+            'hash': [output['hash']],
+            'sun_alt': [output['sun_alt']],
+            'moon_alt': [output['moon_alt']],
+            'moon_phase': [output['moon_phase']],
+            'brightness_mean': [output['brightness_mean']],
+            'brightness_std': [output['brightness_std']],
+            'global_star_perc': [output['global_star_perc']],
+            'global_coverage': [output['global_coverage']],
+        })
+
+        poi = output['points_of_interest'].select_dtypes(include=[np.number]).reset_index(drop=True)
+        poi.insert(0, 'timestamp', timestamp)
+
+        with pd.HDFStore(self.part_file(timestamp), mode='a', complevel=5, complib='blosc') as store:
+            store.append('stars', stars, format='table', index=False,
+                    data_columns=['timestamp', 'HIP', 'altitude'])
+            store.append('global', glob_row, format='table', index=False,
+                    data_columns=['timestamp'], min_itemsize={'hash': 40})
+            if not poi.empty:
+                store.append('points_of_interest', poi, format='table', index=False,
+                        data_columns=['timestamp', 'ID'])
+            if output.get('profile'):
+                profile = pd.DataFrame(output['profile'], columns=['stage', 'wall', 'cpu', 'peak_memory'])
+                profile.insert(0, 'timestamp', timestamp)
+                store.append('profile', profile, format='table', index=False,
+                        data_columns=['timestamp', 'stage'], min_itemsize={'stage': 32})
+
+    def nights(self, start=None, end=None):
+        '''
+        Returns sorted list of all nights in the store between start and end
+        '''
+        nights = sorted(
+                os.path.basename(d) for d in glob(os.path.join(self.path, self.camera, '*'))
+                if os.path.isdir(d)
+        )
+        if start is not None:
+            nights = [n for n in nights if n >= self.night(start)]
+        if end is not None:
+            nights = [n for n in nights if n <= self.night(end)]
+        return nights
+
+    def iterate(self, key='stars', start=None, end=None, hip=None, altitude=None, columns=None):
+        '''
+        Yield one DataFrame per part file with all rows of table 'key' that match the filters.
+        Only the matching rows get read from disk.
+
+        start, end: time range (anything pd.Timestamp understands)
+        hip: HIP number or list of HIP numbers (only for key='stars')
+        altitude: (min, max) altitude band in radians (only for key='stars')
+        '''
+        log = logging.getLogger(__name__)
+        where = []
+        if start is not None:
+            where.append('timestamp >= {!r}'.format(str(pd.Timestamp(start))))
+        if end is not None:
+            where.append('timestamp <= {!r}'.format(str(pd.Timestamp(end))))
+        if hip is not None:
+            where.append('HIP in {}'.format(list(map(int, np.atleast_1d(hip)))))
+        if altitude is not None:
+            where.append('altitude >= {} & altitude <= {}'.format(float(altitude[0]), float(altitude[1])))
+
+        for night in self.nights(start, end):
+            for part in sorted(glob(os.path.join(self.path, self.camera, night, 'part-*.h5'))):
+                try:
+                    yield pd.read_hdf(part, key, where=where or None, columns=columns)
+                except KeyError:
+                    log.debug('No table {} in {}'.format(key, part))
+
+    def read(self, key='stars', start=None, end=None, hip=None, altitude=None, columns=None):
+        '''
+        Returns one DataFrame with all rows of table 'key' that match the filters sorted by time.
+        See iterate() for the filters.
+        '''
+        frames = list(self.iterate(key, start, end, hip, altitude, columns))
+        if not frames:
+            return pd.DataFrame()
+        df = pd.concat(frames, ignore_index=True)
+        if 'timestamp' in df.columns:
+            df.sort_values('timestamp', kind='mergesort', inplace=True)
+        return df
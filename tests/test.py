@@ -1,7 +1,29 @@
 from starry_night import skycam
+from starry_night.store import ResultStore
+from starry_night import sql
+from starry_night import forecast
+from starry_night.accumulator import StarStatistics
+from starry_night.cloud_tracker import CloudTracker
+from starry_night.profiling import StageProfiler, RunProfile
+from starry_night import plotting
 from nose.tools import eq_
 import numpy as np
 import pandas as pd
+import tempfile
+import mmap
+import configparser
+import os
+import skimage.filters
+import threading
+import time
+import tracemalloc
+from io import BytesIO
+from datetime import datetime, timedelta
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from scipy.io import savemat
+from scipy.ndimage import label
+from astropy.io import fits
+from sqlalchemy import text
 
 def test_findLocalMaxPos():
     img = np.zeros((480,640))
@@ -76,3 +98,444 @@ def test_getBlobsize():
     image[26,25]=-np.NaN
     b = skycam.getBlobsize(image, 2)
     eq_(b, 202, 'Blob at border failed: {}'.format(b))
+
+def test_findLocalMax():
+    img = np.zeros((480,640))
+    img[10,30] = 1
+    img[479,639] = 2
+    img[200:207,300:307] = np.nan
+
+    x = np.array([30, 3, 638, 303, 301.7, 700])
+    y = np.array([11, 12, 478, 203, 198.2, 10])
+    maxX, maxY, maxValue = skycam.findLocalMax(img, x, y, 2)
+
+    # max in range, no max in range, max at border, only NaNs, NaN in range, outside of image
+    eq_(list(maxX), [30, 3, 639, 0, 299, 700], 'Wrong x: {}'.format(maxX))
+    eq_(list(maxY), [10, 12, 479, 0, 196, 10], 'Wrong y: {}'.format(maxY))
+    eq_(list(maxValue[[0,1,2,4,5]]), [1, 0, 2, 0, 0], 'Wrong value: {}'.format(maxValue))
+    eq_(np.isnan(maxValue[3]), True, 'NaN window should have NaN value')
+
+def test_ResultStore():
+    stars = pd.DataFrame({'vmag':[1., 2., 3.], 'altitude':[0.5, 1.0, 1.5], 'response':[1., 0.5, 0.1]},
+            index=pd.Index([10, 20, 30], name='HIP'))
+    poi = pd.DataFrame({'ID':[1], 'starPercentage':[0.5]})
+    output = {'stars': stars, 'points_of_interest': poi, 'hash': 'abc', 'sun_alt': -0.5, 'moon_alt': -0.5,
+            'moon_phase': 0.1, 'brightness_mean': 1., 'brightness_std': 1., 'global_star_perc': 0.5,
+            'global_coverage': 0.5}
+
+    with tempfile.TemporaryDirectory() as path:
+        store = ResultStore(path, 'GTC')
+        for t in [datetime(2016,3,10,22), datetime(2016,3,11,3), datetime(2016,3,11,22)]:
+            output['timestamp'] = t
+            store.append(output)
+
+        eq_(store.nights(), ['2016-03-10', '2016-03-11'], 'Partitioning by night failed')
+        eq_(len(store.read()), 9, 'Reading all stars failed')
+        eq_(len(store.read(end=datetime(2016,3,11,4))), 6, 'Time range failed')
+        eq_(list(store.read(hip=20).HIP), [20, 20, 20], 'HIP filter failed')
+        eq_(len(store.read(altitude=(0.9, 2))), 6, 'Altitude filter failed')
+        eq_(len(store.read('global')), 3, 'Reading global table failed')
+
+def test_StageProfiler():
+    profile = RunProfile()
+    for t in range(3):
+        profiler = StageProfiler(t)
+        profiler.start('allocate')
+        x = np.ones(2**20)
+        profiler.start('sum')
+        x.sum()
+        profiler.close()
+        profile.add(profiler.records)
+        eq_(tracemalloc.is_tracing(), False, 'Tracing was not stopped')
+    disabled = StageProfiler(0, enabled=False)
+    disabled.start('allocate')
+    disabled.close()
+
+    eq_(disabled.records, [], 'Disabled profiler recorded stages')
+
+    # a stage that raises must not leave tracing on
+    config = configparser.RawConfigParser()
+    config.read(os.path.join(os.path.dirname(skycam.__file__), 'data', 'GTC_cam.config'))
+    images = {'img': np.zeros((480, 640)), 'timestamp': datetime(2016, 3, 10, 22)}
+    try:
+        skycam.process_image(images, {}, config, {'--profile': 'profile.csv'})
+    except KeyError:
+        pass
+    else:
+        assert False, 'Stage did not raise'
+    eq_(tracemalloc.is_tracing(), False, 'Tracing was not stopped after an exception')
+    summary = profile.summary()
+    eq_(list(summary.index), ['allocate', 'sum'], 'Stage order failed')
+    eq_(list(summary['count']), [3, 3], 'Stage count failed')
+    assert summary.peak_memory_p50['allocate'] >= 8 * 2**20, 'Peak memory of numpy array not traced'
+
+    with tempfile.TemporaryDirectory() as path:
+        profile.write(os.path.join(path, 'profile.csv'))
+        eq_(len(pd.read_csv(os.path.join(path, 'profile.csv'))), 2, 'Writing CSV report failed')
+
+def test_SqlWriter():
+    poi = pd.DataFrame({'ID':[1, 2], 'ra':[0.1, 0.2], 'dec':[0.3, 0.4], 'starPercentage':[0.5, np.float64(0.6)]})
+    output = {'points_of_interest': poi, 'hash': 'abc', 'sun_alt': -0.5, 'moon_alt': -0.5, 'moon_phase': 0.1,
+            'brightness_mean': np.float64(1.), 'brightness_std': np.float64(1.),
+            'global_star_perc': np.float64(0.5), 'global_coverage': np.float64(0.5)}
+
+    writer = sql.SqlWriter('sqlite://', batch_size=2)
+    for t in [datetime(2016,3,10,22), datetime(2016,3,10,23), datetime(2016,3,10,23), datetime(2016,3,11,0)]:
+        output['timestamp'] = t
+        writer.add(output)
+    eq_(len(writer.pending), 0, 'Batch was not flushed')
+
+    with writer.engine.connect() as con:
+        eq_(con.execute(text('SELECT COUNT(*) FROM global')).scalar(), 3, 'Duplicate was not skipped')
+        eq_(con.execute(text('SELECT COUNT(*) FROM local')).scalar(), 8, 'POI entries missing')
+
+    # buffered entries get flushed in the background without further images
+    with tempfile.TemporaryDirectory() as path:
+        writer = sql.SqlWriter('sqlite:///' + os.path.join(path, 'test.db'), batch_size=100, flush_interval=0.1)
+        writer.add(output)
+        time.sleep(0.5)
+        eq_(len(writer.pending), 0, 'Entries were not flushed after flush_interval')
+        with writer.engine.connect() as con:
+            eq_(con.execute(text('SELECT COUNT(*) FROM global')).scalar(), 1, 'Entry missing')
+
+def test_downloadImg():
+    # local stand-in for the camera server, honoring conditional requests
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.headers.get('If-None-Match') == self.server.etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Last-Modified', self.server.lastMod)
+            self.send_header('ETag', self.server.etag)
+            self.end_headers()
+            self.wfile.write(self.server.content)
+        def log_message(self, *args):
+            pass
+
+    def publish(server, value, lastMod):
+        buf = BytesIO()
+        savemat(buf, {'pic': np.full((200, 200), value)})
+        server.content = buf.getvalue()
+        server.lastMod = lastMod
+        server.etag = '"{}"'.format(value)
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    publish(server, 1., 'Thu, 10 Mar 2016 22:00:00 GMT')
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:{}/image.mat'.format(server.server_port)
+        state = skycam.CameraState(url)
+        img = skycam.downloadImg(url, timeout=5, state=state)
+        eq_(img['img'][0, 0], 1., 'Wrong image')
+        eq_(img['timestamp'], datetime(2016, 3, 10, 22), 'Wrong timestamp')
+
+        try:
+            skycam.downloadImg(url, timeout=5, state=state)
+            raise AssertionError('Same image was downloaded twice')
+        except skycam.TooEarlyError:
+            pass
+
+        publish(server, 2., 'Thu, 10 Mar 2016 22:02:00 GMT')
+        img = skycam.downloadImg(url, timeout=5, state=state)
+        eq_(img['img'][0, 0], 2., 'New image was not downloaded')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_getBlobsizes():
+    windows = np.zeros((3,11,11))
+    windows[0, 4:7, 4:7] = 1
+    windows[1, 4, 4] = 1
+    windows[1, 6, 6] = 1
+    windows[2, :, 0] = 1
+    b = skycam.getBlobsizes(windows, np.array([0.5, 0.5, 0.5]))
+    eq_(list(b), [9, 2, 0], 'Batch blob size failed: {}'.format(b))
+
+    b = skycam.getBlobsizes(windows, 0.5, limit=5)
+    eq_(list(b), [5, 2, 0], 'Batch limit failed: {}'.format(b))
+
+def test_filterBank():
+    img = np.random.RandomState(0).rand(101,121)
+    img[40:50,60:65] = np.nan
+    cube = skycam.filterBank(img, [1, 2, 3.5])
+    eq_(cube.shape, (3,101,121), 'Wrong shape: {}'.format(cube.shape))
+    for sigma, resp in zip([1, 2, 3.5], cube):
+        direct = skimage.filters.laplace(skimage.filters.gaussian(img, sigma=sigma), ksize=3).clip(min=0)
+        eq_(np.array_equal(np.isnan(resp), np.isnan(direct)), True, 'NaN area differs for sigma {}'.format(sigma))
+        eq_(np.allclose(resp[15:-15,15:-15], direct[15:-15,15:-15], equal_nan=True, atol=1e-4), True,
+                'Response differs for sigma {}'.format(sigma))
+
+    # stacked response is searched for all kernels at once
+    maxX, maxY, maxValue = skycam.findLocalMax(cube, [30, 100], [20, 80], 2)
+    for i in range(3):
+        eq_(list(maxValue[i]), list(skycam.findLocalMax(cube[i], [30, 100], [20, 80], 2)[2]), 'Stack failed')
+
+def test_ratescan():
+    img = np.random.RandomState(1).rand(40,50)**3
+    img[5:8,10:20] = np.nan
+    response = np.array([0.5, 0.01, np.nan, 0.2])
+    thresholds = np.logspace(-3, -0.1, 30)
+    result = skycam.ratescan(img, response, thresholds)
+    for t, row in zip(thresholds, result):
+        labeled, labelCnt = label(img > t)
+        eq_(list(row), [np.sum(response > t)/4, np.sum(img > t), labelCnt, np.sum(response > t)],
+                'Ratescan failed for threshold {}'.format(t))
+
+def test_calc_star_percentages():
+    stars = pd.DataFrame({'ra': np.deg2rad([10, 11, 12, 200]), 'dec': np.deg2rad([20, 20, 21, -30]),
+        'vmag': [1, 2, 3, 4], 'visible': [1, 0, 0.5, 1]})
+    pois = pd.DataFrame({'ra': np.deg2rad([10.5, 200, 100]), 'dec': np.deg2rad([20, -30, 0]), 'radius': [3, 1, 1]})
+    perc = skycam.calc_star_percentages(pois, stars, pois.radius.values, weight=True)
+    for p, (_, poi) in zip(perc, pois.iterrows()):
+        eq_(np.isclose(p, skycam.calc_star_percentage(poi, stars, poi.radius, unit='deg', lim=-1, weight=True)), True,
+                'Star percentage differs: {}'.format(p))
+    eq_(list(perc[1:]), [1, -1], 'Wrong star percentage: {}'.format(perc))
+
+def test_filter_catalogue():
+    catalogue = pd.DataFrame({'ra': [10, 10.8, 11.9, 180, 359.8, 0.3], 'dec': [0, 0, 0, 89.9, 0, 0],
+        'vmag': [3, 1, 2, 4, 5, 4.5]}, index=pd.Index([1, 2, 3, 4, 5, 6], name='HIP'))
+    # 2 removes 1 but not 3, 6 removes 5 across ra=0
+    index = skycam.filter_catalogue(catalogue, 1)
+    eq_(list(index), [2, 3, 4, 6], 'Wrong stars left: {}'.format(list(index)))
+
+def test_load_catalogue():
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, 'catalogue.csv')
+        with open(filename, 'w') as f:
+            f.write('HIP,gLon,gLat,ra,dec,vmag\n1,0,0,90,0,1.5\n2,0,0,0,90,3\n')
+        cache = os.path.join(path, 'cache')
+        catalogue = skycam.load_catalogue(filename, cache)
+        eq_(list(catalogue['HIP']), [1, 2], 'Wrong HIP')
+        eq_(np.allclose(catalogue['ra'], [np.pi/2, 0]), True, 'ra not in radians')
+        eq_(np.allclose([catalogue['uy'][0], catalogue['uz'][1]], [1, 1]), True, 'Wrong unit vectors')
+
+        # cached file gets memory mapped, a changed csv creates a new cache
+        eq_(isinstance(skycam.load_catalogue(filename, cache), np.memmap), True, 'Cache not used')
+        # cache of another file with the same prefix must be kept
+        other = os.path.join(path, 'catalogue-bright.csv')
+        with open(other, 'w') as f:
+            f.write('HIP,gLon,gLat,ra,dec,vmag\n1,0,0,90,0,1.5\n')
+        skycam.load_catalogue(other, cache)
+        with open(filename, 'a') as f:
+            f.write('3,0,0,0,0,5\n')
+        eq_(len(skycam.load_catalogue(filename, cache)), 3, 'Cache was not invalidated')
+        eq_(len(os.listdir(cache)), 2, 'Old cache was not removed or other cache was removed')
+
+def test_find_matching_pos():
+    minute = 1/24/60
+    table = pd.DataFrame({'MJD': 57000 + minute*np.array([9, 1, 7, 6, 7, 20]), 'ra': [1, 2, 3, 4, 5, 6], 'dec': [0, 0, 0, 0, 1, 0]})
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, 'positions.h5')
+        table.to_hdf(filename, key='table')
+        positioning = skycam.load_positioning(filename, cache_dir=os.path.join(path, 'cache'))
+        eq_(np.all(np.diff(positioning['MJD']) >= 0), True, 'Positioning table is not sorted')
+
+        for time_pos_list in (table.sort_values('MJD'), positioning):
+            pos = skycam.find_matching_pos(57000, time_pos_list)
+            eq_(list(pos.ra), [4], 'Wrong position: {}'.format(pos))
+            eq_(skycam.find_matching_pos(57001, time_pos_list).empty, True, 'Position without match')
+
+        # only positions that can match images between start and end are loaded
+        positioning = skycam.load_positioning(filename, datetime(2014, 12, 9), datetime(2014, 12, 9, 0, 1),
+                cache_dir=os.path.join(path, 'cache'))
+        eq_(list(positioning['ra']), [2, 4, 3, 5, 1], 'Wrong time span: {}'.format(positioning))
+
+def test_read_images():
+    config = configparser.RawConfigParser()
+    config.read_dict({'properties': {'timeformat': 'gtc_allskyimage_%Y%m%d_%H%M%S', 'timeoffset': '-7'}})
+    with tempfile.TemporaryDirectory() as path:
+        files = []
+        for i in range(5):
+            files.append(os.path.join(path, 'img_{}.mat'.format(i)))
+            savemat(files[-1], {'pic1': np.full((10, 10), i), 'UTC1': ['2016/03/10 22:0{}:00'.format(i)]})
+        with open(files[2], 'w') as f:
+            f.write('broken')
+
+        images = list(skycam.read_images(files, config, threads=2, prefetch=2))
+        eq_([img['img'][0, 0] for img in images], [0, 1, 3, 4], 'Wrong images or order')
+        eq_(images[0]['timestamp'], datetime(2016, 3, 10, 21, 53), 'Wrong timestamp')
+
+    timestamps = skycam.parse_timestamps(['a/gtc_allskyimage_20160310_223000.jpg', 'a/b.mat', 'a/foo.jpg'], config)
+    eq_(list(timestamps.isnull()), [False, True, True], 'Wrong NaT')
+    eq_(timestamps[0], pd.Timestamp('2016-03-10 22:23'), 'Wrong timestamp')
+
+def test_float32_precision():
+    # star responses of the single precision path differ by less than 1e-4 from double precision
+    rng = np.random.RandomState(2)
+    img = rng.normal(0.1, 0.005, (200, 300))
+    y, x = np.mgrid[:200, :300]
+    starX, starY = rng.uniform(10, 290, 40), rng.uniform(10, 190, 40)
+    for sx, sy, flux in zip(starX, starY, rng.uniform(0.01, 1, 40)):
+        img += flux * np.exp(-((x-sx)**2 + (y-sy)**2) / 2.)
+    img[:20, :50] = np.nan
+
+    for function in ('LoG', 'DoG'):
+        resp64 = skycam.findLocalMax(skycam.filterBank(img, [1, 2], function), starX, starY, 2)[2]
+        resp32 = skycam.findLocalMax(skycam.filterBank(img.astype(np.float32), [1, 2], function), starX, starY, 2)[2]
+        found = np.abs(resp64) > 1e-3
+        eq_(np.array_equal(np.isnan(resp64), np.isnan(resp32)), True, 'NaN differs')
+        eq_(np.nanmax(np.abs(resp32[found] / resp64[found] - 1)) < 1e-4, True, '{} not precise enough'.format(function))
+
+def test_getImageDict_memmap():
+    config = configparser.RawConfigParser()
+    config.read_dict({'properties': {'timeoffset': '0'}})
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, 'image.fits')
+        hdu = fits.PrimaryHDU(np.arange(12, dtype=np.float32).reshape(3, 4))
+        hdu.header['TIMEUTC'] = '2016-03-10 22:00:00'
+        hdu.writeto(filename)
+
+        image = skycam.getImageDict(filename, config, memmap=True)
+        # depending on astropy and numpy there are views between the image and the mmap
+        base = image['img']
+        while base is not None and not isinstance(base, mmap.mmap):
+            base = getattr(base, 'base', None)
+        eq_(isinstance(base, mmap.mmap), True, 'Image is not memory mapped')
+        eq_(image['img'][2, 3], 11, 'Wrong image')
+        eq_(image['timestamp'], datetime(2016, 3, 10, 22), 'Wrong timestamp')
+
+def test_StarStatistics():
+    rng = np.random.RandomState(0)
+    tables = [pd.DataFrame({'vmag': rng.rand(5), 'altitude': rng.rand(5)},
+            index=pd.Index(rng.choice(8, 5, replace=False), name='HIP')) for i in range(12)]
+    df = pd.concat(tables, keys=range(12), names=['date', 'HIP'])
+
+    first, second = StarStatistics(), StarStatistics()
+    for i, stars in enumerate(tables):
+        (first if i < 5 else second).add(stars)
+    first.merge(second)
+    mean, std = first.mean_std()
+
+    keep = df.groupby(level='HIP').vmag.count() > 6
+    grouped = df.groupby(level='HIP')
+    eq_(first.images, 12, 'Wrong image count')
+    eq_(list(mean.index), list(keep.index[keep.values]), 'Wrong stars selected')
+    eq_(np.allclose(mean.vmag, grouped.vmag.mean()[keep.values]), True, 'Wrong mean')
+    eq_(np.allclose(std.altitude, grouped.altitude.std()[keep.values]), True, 'Wrong std')
+    eq_(np.allclose(first.min_altitude, grouped.altitude.min()), True, 'Wrong min altitude')
+    eq_(np.allclose(first.max_altitude, grouped.altitude.max()), True, 'Wrong max altitude')
+
+def test_fit_transmission():
+    rng = np.random.RandomState(1)
+    altitude = np.tile(np.linspace(0.3, 1.5, 20), 3)
+    hip = np.repeat([5, 7, 9], 20)
+    a = np.array([1., 0.5, 2.])[hip // 2 - 2]
+    c = np.array([0.2, 0.5, 0.6])[hip // 2 - 2]
+    response = skycam.transmission3(altitude, a, c)
+    response[-20:] *= 1 + 0.01*rng.randn(20)
+
+    fit = skycam.fit_transmission(hip, altitude, response)
+    eq_(list(fit.index), [5, 7, 9], 'Wrong stars')
+    eq_(np.allclose(fit.a[[5, 7]], [1., 0.5]) and np.allclose(fit.c[[5, 7]], [0.2, 0.5]), True, 'Exact fit failed')
+    eq_(np.allclose(fit.sigma_c[[5, 7]], 0, atol=1e-8), True, 'Exact fit has uncertainty')
+    eq_(abs(fit.c[9] - 0.6) < 3*fit.sigma_c[9] and fit.sigma_c[9] > 0, True, 'Noisy fit failed')
+    eq_(np.isnan(skycam.fit_transmission([1, 1], [0.5, 1.], [1., 0.9]).c[1]), True, 'Two points must not be fitted')
+
+def test_CloudMapper():
+    config = configparser.RawConfigParser()
+    config.read(os.path.join(os.path.dirname(skycam.__file__), 'data', 'GTC_cam.config'))
+    data = skycam.celObjects_dict(config)
+    observer = skycam.obs_setup(config['properties'])
+    observer.date = datetime(2016, 3, 10, 23, 30)
+    data['timestamp'] = datetime(2016, 3, 10, 23, 30)
+    crop = skycam.get_crop_mask(np.zeros((480, 640)), config['crop'])
+    stars = skycam.update_star_position(data, observer, config, crop, {'-p': None})['stars'].iloc[5:]
+    stars['visible'] = (stars.x.values < 320).astype(float)
+
+    cloud_map = skycam.calc_cloud_map(stars, 8, (480, 640), weight=True)
+    eq_(cloud_map.shape, (480, 640), 'Wrong shape')
+    eq_(cloud_map[200, 100] < 0.1 and cloud_map[200, 540] > 0.9, True, 'Wrong cloudiness')
+
+    mapper = skycam.CloudMapper(data['geometry'], (480, 640), 8, crop_mask=crop, node_step=1e-9)
+    cached = mapper.cloud_map(stars, float(observer.sidereal_time()))
+    eq_(np.allclose(cached, cloud_map, atol=1e-6), True, 'Cached density of all stars differs')
+
+def test_CloudTracker():
+    rows, cols = np.mgrid[:480, :640]
+    def cloudMap(minutes):
+        # one cloud moving 6 pixel/min to the right and 3 pixel/min down
+        x, y = 150 + 6*minutes, 200 + 3*minutes
+        return np.exp(-((cols - x)**2 + (rows - y)**2) / (2*40**2))
+
+    tracker = CloudTracker({'zenith_x': 320, 'zenith_y': 240, 'radius': 300})
+    start = datetime(2016, 3, 10, 22)
+    for minutes in range(0, 12, 2):
+        tracker.update(cloudMap(minutes), start + timedelta(minutes=minutes))
+
+    eq_(len(tracker.clouds), 1, 'Wrong number of clouds')
+    cloud = tracker.clouds[0]
+    eq_(abs(cloud.speed - np.hypot(6, 3)) < 0.5, True, 'Wrong speed {}'.format(cloud.speed))
+    eq_(abs(cloud.direction - np.arctan2(3, 6)) < 0.1, True, 'Wrong direction {}'.format(cloud.direction))
+    eq_(np.abs(tracker.forecast(10) - cloudMap(20)).mean() < 0.01, True, 'Forecast failed')
+    eq_(list(tracker.coverage([270, 50], [260, 50], 10) > 0.5), [True, False], 'Coverage forecast failed')
+
+def test_forecast_star_percentages():
+    config = configparser.RawConfigParser()
+    config.read(os.path.join(os.path.dirname(skycam.__file__), 'data', 'GTC_cam.config'))
+    data = skycam.celObjects_dict(config)
+    timestamp = datetime(2016, 3, 10, 23, 30)
+    st = forecast.sidereal_time(config, timestamp)
+    poi = data['points_of_interest']
+    az, alt, x, y = forecast.poi_tracks(poi, data['geometry'], st, [0, 60*24/1.0027379])
+    eq_(np.allclose(x[:, 0], x[:, 1]) and np.allclose(y[:, 0], y[:, 1]), True, 'Track is not periodic')
+
+    # cloud on top of the first point of interest, everything else is clear
+    rows, cols = np.mgrid[:480, :640]
+    tracker = CloudTracker(config['image'])
+    tracker.update(((cols - x[0, 0])**2 + (rows - y[0, 0])**2 < 60**2).astype(float), timestamp)
+    percentages = forecast.forecast_star_percentages(tracker, poi, data['geometry'], st, minutes=[0, 10])
+    eq_(percentages.shape, (len(poi), 2), 'Wrong shape')
+    eq_(list(percentages.iloc[0] < 0.1), [True, True], 'Covered point of interest is clear')
+    observable = (alt[:, 0] > data['geometry'].min_altitude)
+    eq_(np.array_equal(percentages[0.0].notnull().values, observable), True, 'Wrong observable points')
+    far = observable & (np.hypot(x[:, 0] - x[0, 0], y[:, 0] - y[0, 0]) > 150)
+    eq_(far.any() and np.allclose(percentages[0.0].values[far], 1), True, 'Clear points of interest are covered')
+
+def test_Renderer():
+    config = configparser.RawConfigParser()
+    config.read(os.path.join(os.path.dirname(skycam.__file__), 'data', 'GTC_cam.config'))
+    args = {'--cam': True, '--daemon': False, '--single': True, '--response': False, '--cloudmap': True,
+            '-s': True, '-v': False, '--function': 'LoG', '-c': 'GTC'}
+    stars = pd.DataFrame({'x': [100., 300.], 'y': [200., 250.], 'vmag': [1., 3.], 'response': [0.1, 0.01], 'visible': [1., 0.]})
+    poi = pd.DataFrame({'x': [320.], 'y': [240.]})
+    img = np.random.RandomState(0).rand(480, 640)
+    eq_(plotting.plot_record(img, stars, poi, None, config, dict(args, **{'--cam': False, '--cloudmap': False}),
+        datetime(2016, 3, 10, 22)), None, 'Record without plots')
+
+    with tempfile.TemporaryDirectory() as path:
+        cwd = os.getcwd()
+        os.chdir(path)
+        try:
+            renderer = plotting.Renderer(min_interval=3600)
+            for t in [datetime(2016, 3, 10, 22), datetime(2016, 3, 10, 22, 2)]:
+                record = plotting.plot_record(img, stars, poi, np.zeros((480, 640)), config, args, t)
+                renderer.submit(record)
+            # same file again, gets replaced or throttled
+            renderer.submit(record)
+            renderer.close()
+        finally:
+            os.chdir(cwd)
+        eq_(sorted(os.listdir(path)), ['cam_image_2016-03-10T22:00:00.pdf', 'cam_image_2016-03-10T22:02:00.pdf',
+            'cloudMap_2016-03-10T22:00:00.png', 'cloudMap_2016-03-10T22:02:00.png'], 'Rendering failed')
+        eq_((renderer.rendered, renderer.skipped), (4, 2), 'Throttling failed')
+        eq_(sorted(renderer.plots), [('GTC', 'cam', (480, 640)), ('GTC', 'cloudmap', (480, 640))], 'Figures are not reused')
+
+def test_Renderer_cameras():
+    stars = pd.DataFrame({'x': [100., 300.], 'y': [200., 250.], 'vmag': [1., 3.], 'response': [0.1, 0.01], 'visible': [1., 0.]})
+    poi = pd.DataFrame({'x': [320.], 'y': [240.]})
+    args = {'--cam': True, '--daemon': False, '--single': False, '--response': False, '--cloudmap': False,
+            '-s': True, '-v': False, '--function': 'LoG'}
+    renderer = plotting.Renderer()
+    with tempfile.TemporaryDirectory() as path:
+        for name, shape in [('GTC', (480, 640)), ('CTA', (1699, 1699))]:
+            config = configparser.RawConfigParser()
+            config.read(os.path.join(os.path.dirname(skycam.__file__), 'data', '{}_cam.config'.format(name)))
+            img = np.random.RandomState(0).rand(*shape)
+            record = plotting.plot_record(img, stars, poi, None, config, dict(args, **{'-c': name}), datetime(2016, 3, 10, 22))
+            renderer.render('cam', record, os.path.join(path, '{}.pdf'.format(name)))
+            extent = renderer.plots[(name, 'cam', shape)].image.get_extent()
+            eq_(list(extent), [-0.5, shape[1]-0.5, shape[0]-0.5, -0.5], 'Wrong extent of camera {}'.format(name))
+    renderer.close()